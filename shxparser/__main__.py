@@ -0,0 +1,5 @@
+import sys
+
+from .shxbatch import main
+
+sys.exit(main())
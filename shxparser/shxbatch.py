@@ -0,0 +1,323 @@
+"""
+Batch rendering of text jobs. Jobs are JSON objects, one per line:
+
+    {"font": "romans.shx", "text": "Hello", "size": 12.0, "x": 0, "y": 0, "format": "svg"}
+
+Only font and text are required. The optional "horizontal" key selects horizontal or vertical text, "output" names a
+file to write the result to instead of the output stream. The text style keys "rotation", "width_factor" and "oblique"
+are given in degrees and rotate or distort the text around its start position. Bigfonts indexed by a multibyte encoding
+take the python "codec" of that encoding, such as "cp932" or "gbk", so unicode text finds its glyphs.
+
+Each worker keeps a render cache, a text repeated with the same font, size and direction is replayed at its new
+position rather than rendered again.
+
+Results are written in job order in one of three formats:
+
+* svg: one <svg> document per job.
+* gcode: G0/G1/G2/G3 moves per job.
+* binary: per job a 32-bit little endian payload length followed by segment records. Each record is a type byte
+    (0 new path, 1 move, 2 line, 3 arc) followed by 0, 2, 4 or 6 little endian 32-bit floats.
+"""
+
+import argparse
+import json
+import struct
+import sys
+from math import cos, hypot, pi, radians, sin, tau
+from multiprocessing import Pool
+
+from .shxparser import ShxFont, ShxRenderCache, arc_center, arc_sweep, text_matrix
+
+FORMATS = ("svg", "gcode", "binary")
+
+_fonts = dict()  # Font cache, by filename and codec.
+_cache = ShxRenderCache()  # Render cache, repeated texts are replayed rather than rendered again.
+
+
+def load_font(filename, codec=None):
+    """
+    Loads the font from the cache, parsing it the first time it is used.
+    """
+    try:
+        return _fonts[filename, codec]
+    except KeyError:
+        font = ShxFont(filename, codec=codec)
+        _fonts[filename, codec] = font
+        return font
+
+
+class ShxSvgPath:
+    """
+    Path that builds an SVG document. The y-axis is flipped so text reads upright.
+    """
+
+    def __init__(self):
+        self.d = list()
+        self.bounds = [float("inf"), float("inf"), -float("inf"), -float("inf")]
+        self._x = None
+        self._y = None
+
+    def _point(self, x, y):
+        b = self.bounds
+        b[0] = min(b[0], x)
+        b[1] = min(b[1], -y)
+        b[2] = max(b[2], x)
+        b[3] = max(b[3], -y)
+
+    def _start(self, x, y):
+        if self._x != x or self._y != y:
+            self.move(x, y)
+
+    def new_path(self):
+        pass
+
+    def move(self, x, y):
+        self._point(x, y)
+        if self.d and self.d[-1][0] == "M":
+            # Consecutive moves collapse into the last one.
+            self.d.pop()
+        self.d.append(f"M{x:g},{-y + 0.0:g}")
+        self._x, self._y = x, y
+
+    def line(self, x0, y0, x1, y1):
+        self._start(x0, y0)
+        self._point(x1, y1)
+        self.d.append(f"L{x1:g},{-y1 + 0.0:g}")
+        self._x, self._y = x1, y1
+
+    def arc(self, x0, y0, cx, cy, x1, y1):
+        center = arc_center(x0, y0, cx, cy, x1, y1)
+        if center is None:
+            self.line(x0, y0, x1, y1)
+            return
+        self._start(x0, y0)
+        self._point(cx, cy)
+        ox, oy = center
+        sweep = arc_sweep(x0, y0, cx, cy, x1, y1, ox, oy)
+        self._arc(hypot(x0 - ox, y0 - oy), sweep, cx, cy, x1, y1)
+
+    def center_arc(self, x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle, ccw):
+        self._start(x0, y0)
+        mid_angle = (start_angle + end_angle) / 2
+        mx = cx + radius * cos(mid_angle)
+        my = cy + radius * sin(mid_angle)
+        self._point(mx, my)
+        self._arc(radius, end_angle - start_angle, mx, my, x1, y1)
+
+    def _arc(self, r, sweep, mx, my, x1, y1):
+        self._point(x1, y1)
+        if abs(sweep) >= tau:
+            # SVG cannot draw a full circle as a single arc.
+            self.d.append(f"A{r:g},{r:g} 0 0,{int(sweep < 0)} {mx:g},{-my + 0.0:g}")
+        large = int(abs(sweep) % tau > pi)
+        self.d.append(f"A{r:g},{r:g} 0 {large},{int(sweep < 0)} {x1:g},{-y1 + 0.0:g}")
+        self._x, self._y = x1, y1
+
+    def data(self):
+        min_x, min_y, max_x, max_y = self.bounds
+        if min_x > max_x:
+            min_x = min_y = max_x = max_y = 0
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" '
+            f'viewBox="{min_x:g} {min_y:g} {max_x - min_x:g} {max_y - min_y:g}">'
+            f'<path fill="none" stroke="black" d="{" ".join(self.d)}"/></svg>\n'
+        ).encode("utf-8")
+
+
+class ShxGcodePath:
+    """
+    Path that builds G-code. Moves are G0, lines are G1, arcs are G2 (clockwise) or G3 (counterclockwise).
+    """
+
+    def __init__(self):
+        self.lines = ["G90"]
+        self._x = None
+        self._y = None
+
+    def _start(self, x, y):
+        if self._x != x or self._y != y:
+            self.move(x, y)
+
+    def new_path(self):
+        pass
+
+    def move(self, x, y):
+        if self.lines[-1].startswith("G0 "):
+            # Consecutive moves collapse into the last one.
+            self.lines.pop()
+        self.lines.append(f"G0 X{x:.4f} Y{y:.4f}")
+        self._x, self._y = x, y
+
+    def line(self, x0, y0, x1, y1):
+        self._start(x0, y0)
+        self.lines.append(f"G1 X{x1:.4f} Y{y1:.4f}")
+        self._x, self._y = x1, y1
+
+    def arc(self, x0, y0, cx, cy, x1, y1):
+        center = arc_center(x0, y0, cx, cy, x1, y1)
+        if center is None:
+            self.line(x0, y0, x1, y1)
+            return
+        self._start(x0, y0)
+        ox, oy = center
+        sweep = arc_sweep(x0, y0, cx, cy, x1, y1, ox, oy)
+        command = "G3" if sweep > 0 else "G2"
+        self.lines.append(f"{command} X{x1:.4f} Y{y1:.4f} I{ox - x0:.4f} J{oy - y0:.4f}")
+        self._x, self._y = x1, y1
+
+    def center_arc(self, x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle, ccw):
+        self._start(x0, y0)
+        command = "G3" if ccw else "G2"
+        self.lines.append(f"{command} X{x1:.4f} Y{y1:.4f} I{cx - x0:.4f} J{cy - y0:.4f}")
+        self._x, self._y = x1, y1
+
+    def data(self):
+        return ("\n".join(self.lines) + "\n").encode("utf-8")
+
+
+class ShxBinaryPath:
+    """
+    Path that builds compact binary segment records.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def new_path(self):
+        self.buffer += b"\x00"
+
+    def move(self, x, y):
+        self.buffer += struct.pack("<B2f", 1, x, y)
+
+    def line(self, x0, y0, x1, y1):
+        self.buffer += struct.pack("<B4f", 2, x0, y0, x1, y1)
+
+    def arc(self, x0, y0, cx, cy, x1, y1):
+        self.buffer += struct.pack("<B6f", 3, x0, y0, cx, cy, x1, y1)
+
+    def data(self):
+        return struct.pack("<I", len(self.buffer)) + bytes(self.buffer)
+
+
+PATHS = {"svg": ShxSvgPath, "gcode": ShxGcodePath, "binary": ShxBinaryPath}
+
+
+def render_job(job, default_format="svg"):
+    """
+    Renders a single job.
+
+    :param job: job dictionary.
+    :param default_format: format used when the job does not give one.
+    :return: output filename or None, rendered bytes
+    """
+    output_format = job.get("format", default_format)
+    try:
+        path = PATHS[output_format]()
+    except KeyError:
+        raise ValueError(f"{output_format} is not a valid output format.")
+    matrix = None
+    if "rotation" in job or "width_factor" in job or "oblique" in job:
+        matrix = text_matrix(
+            radians(float(job.get("rotation", 0))),
+            float(job.get("width_factor", 1)),
+            radians(float(job.get("oblique", 0))),
+        )
+    font = load_font(job["font"], job.get("codec"))
+    options = dict(
+        horizontal=job.get("horizontal", True),
+        font_size=float(job.get("size", 12.0)),
+        x=float(job.get("x", 0)),
+        y=float(job.get("y", 0)),
+        matrix=matrix,
+    )
+    if _cache is not None:
+        _cache.render(font, path, job["text"], **options)
+    else:
+        font.render(path, job["text"], **options)
+    return job.get("output"), path.data()
+
+
+def _work(args):
+    """
+    Pool worker. Errors are returned rather than raised so a bad job does not stop the batch.
+    """
+    number, job, default_format = args
+    try:
+        if isinstance(job, Exception):
+            raise job
+        output, data = render_job(job, default_format)
+        return number, output, data, None
+    except Exception as e:
+        return number, None, None, f"{type(e).__name__}: {e}"
+
+
+def _init_worker(preload, cache_size=None):
+    global _cache
+    if cache_size is not None:
+        _cache = ShxRenderCache(cache_size) if cache_size > 0 else None
+    for filename in preload:
+        load_font(filename)
+
+
+def read_jobs(stream, default_format):
+    """
+    Reads JSONL jobs from a stream. Blank lines are skipped, invalid lines are passed on as errors.
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("Job is not a JSON object.")
+        except ValueError as e:
+            job = e
+        yield number, job, default_format
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="shxparser", description="Render JSONL text jobs with SHX fonts.")
+    parser.add_argument("input", nargs="?", default="-", help="JSONL job file, - for stdin (default)")
+    parser.add_argument("-o", "--output", default="-", help="output file, - for stdout (default)")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="svg", help="default output format")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes, 1 renders in process")
+    parser.add_argument("-p", "--preload", action="append", default=[], help="font to load before rendering")
+    parser.add_argument("--chunksize", type=int, default=16, help="jobs handed to a worker at a time")
+    parser.add_argument(
+        "--cache-size", type=int, default=1 << 24, help="bytes of rendered text kept per worker, 0 disables the cache"
+    )
+    args = parser.parse_args(argv)
+
+    source = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    sink = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    failures = 0
+    pool = None
+    try:
+        _init_worker(args.preload, args.cache_size)
+        jobs = read_jobs(source, args.format)
+        if args.jobs > 1:
+            pool = Pool(args.jobs, initializer=_init_worker, initargs=(args.preload, args.cache_size))
+            results = pool.imap(_work, jobs, chunksize=max(1, args.chunksize))
+        else:
+            results = map(_work, jobs)
+        for number, output, data, error in results:
+            if error is not None:
+                failures += 1
+                print(f"shxparser: job on line {number} failed. {error}", file=sys.stderr)
+                continue
+            if output is not None:
+                with open(output, "wb") as f:
+                    f.write(data)
+            else:
+                sink.write(data)
+                sink.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if source is not sys.stdin:
+            source.close()
+        if sink is not sys.stdout.buffer:
+            sink.close()
+    return 1 if failures else 0
@@ -1,4 +1,8 @@
-from math import tau, cos, sin, atan2, isinf
+import weakref
+from array import array
+from collections import OrderedDict
+from math import tau, cos, sin, tan, atan, atan2, isinf, hypot, ceil, sqrt
+from sys import getsizeof
 
 SHXPARSER_VERSION = "0.0.2"
 
@@ -19,6 +23,32 @@ BULGE_ARC = 0xC  # dx, dy, bulge
 POLY_BULGE_ARC = 0xD  # 0,0 terminated BULGE_ARC
 COND_MODE_2 = 0x0E  # PROCESS this command *only if mode=2*
 
+STACK_DEPTH = 4  # Position stack overflows when this many locations are pushed.
+SUBSHAPE_DEPTH = 32  # Deepest permitted subshape nesting, deeper glyphs are treated as subshape cycles.
+
+# Number of coordinates of each segment type code: new path, move, line, arc, center arc.
+SEGMENT_LENGTHS = (0, 2, 4, 6, 9)
+
+# Unit vectors for the 16 length/direction code directions, in 22.5° increments ccw from 3 o'clock.
+DIRECTION_VECTORS = (
+    (1.0, 0.0),
+    (1.0, 0.5),
+    (1.0, 1.0),
+    (0.5, 1.0),
+    (0.0, 1.0),
+    (-0.5, 1.0),
+    (-1.0, 1.0),
+    (-1.0, 0.5),
+    (-1.0, 0.0),
+    (-1.0, -0.5),
+    (-1.0, -1.0),
+    (-0.5, -1.0),
+    (0.0, -1.0),
+    (0.5, -1.0),
+    (1.0, -1.0),
+    (1.0, -0.5),
+)
+
 
 def signed8(b):
     if b > 127:
@@ -31,6 +61,10 @@ def int_16le(byte):
     return (byte[0] & 0xFF) + ((byte[1] & 0xFF) << 8)
 
 
+def int_16be(byte):
+    return ((byte[0] & 0xFF) << 8) + (byte[1] & 0xFF)
+
+
 def int_32le(b):
     return (
         (b[0] & 0xFF)
@@ -75,10 +109,151 @@ def read_string(stream):
         raise ShxFontParseError(f"Read string did not capture valid text. {bb}") from e
 
 
+def write_int_8(stream, value):
+    stream.write(bytes((value & 0xFF,)))
+
+
+def write_int_16le(stream, value):
+    stream.write(bytes((value & 0xFF, (value >> 8) & 0xFF)))
+
+
+def write_int_32le(stream, value):
+    stream.write(
+        bytes(
+            (
+                value & 0xFF,
+                (value >> 8) & 0xFF,
+                (value >> 16) & 0xFF,
+                (value >> 24) & 0xFF,
+            )
+        )
+    )
+
+
+def arc_center(x0, y0, cx, cy, x1, y1):
+    """
+    Finds the center of the circle through the start, control and end points of an arc.
+
+    :return: center x, center y or None if the points are collinear.
+    """
+    if hypot(x1 - x0, y1 - y0) < 1e-9:
+        # Full circle, the control point is across the diameter.
+        return (x0 + cx) / 2.0, (y0 + cy) / 2.0
+    d = 2.0 * (x0 * (cy - y1) + cx * (y1 - y0) + x1 * (y0 - cy))
+    if abs(d) < 1e-9:
+        return None
+    s0 = x0 * x0 + y0 * y0
+    sc = cx * cx + cy * cy
+    s1 = x1 * x1 + y1 * y1
+    ox = (s0 * (cy - y1) + sc * (y1 - y0) + s1 * (y0 - cy)) / d
+    oy = (s0 * (x1 - cx) + sc * (x0 - x1) + s1 * (cx - x0)) / d
+    return ox, oy
+
+
+def arc_sweep(x0, y0, cx, cy, x1, y1, ox, oy):
+    """
+    Finds the signed sweep angle of the arc from start to end going through the control point, positive sweeps are
+    counterclockwise.
+    """
+    a0 = atan2(y0 - oy, x0 - ox)
+    span = (atan2(y1 - oy, x1 - ox) - a0) % tau
+    if span == 0:
+        span = tau
+    if (atan2(cy - oy, cx - ox) - a0) % tau <= span:
+        return span
+    return span - tau
+
+
+def text_matrix(rotation=0.0, width_factor=1.0, oblique=0.0):
+    """
+    Affine matrix for the AutoCAD text style options.
+
+    :param rotation: text rotation in radians, counterclockwise.
+    :param width_factor: horizontal scale of the text.
+    :param oblique: slant of the text in radians, positive values lean to the right.
+    :return: matrix (a, b, c, d, e, f) mapping x, y to a * x + c * y + e, b * x + d * y + f
+    """
+    rc = cos(rotation)
+    rs = sin(rotation)
+    t = tan(oblique)
+    return rc * width_factor, rs * width_factor, rc * t - rs, rs * t + rc, 0.0, 0.0
+
+
+def replay_segments(path, codes, coords, x=0.0, y=0.0):
+    """
+    Calls the path methods for segments given as type codes and flat coordinates, see ShxPath. Center arcs become
+    3-point arcs for paths without center_arc().
+
+    :param path: path object receiving the segments, see ShxPath.
+    :param codes: segment type codes.
+    :param coords: flat segment coordinates.
+    :param x: offset added to every x coordinate.
+    :param y: offset added to every y coordinate.
+    """
+    center_arc = getattr(path, "center_arc", None)
+    i = 0
+    for code in codes:
+        if code == 2:
+            path.line(coords[i] + x, coords[i + 1] + y, coords[i + 2] + x, coords[i + 3] + y)
+            i += 4
+        elif code == 1:
+            path.move(coords[i] + x, coords[i + 1] + y)
+            i += 2
+        elif code == 3:
+            path.arc(
+                coords[i] + x,
+                coords[i + 1] + y,
+                coords[i + 2] + x,
+                coords[i + 3] + y,
+                coords[i + 4] + x,
+                coords[i + 5] + y,
+            )
+            i += 6
+        elif code == 4:
+            cx = coords[i + 4] + x
+            cy = coords[i + 5] + y
+            radius, start_angle, end_angle = coords[i + 6], coords[i + 7], coords[i + 8]
+            if center_arc is not None:
+                center_arc(
+                    coords[i] + x,
+                    coords[i + 1] + y,
+                    coords[i + 2] + x,
+                    coords[i + 3] + y,
+                    cx,
+                    cy,
+                    radius,
+                    start_angle,
+                    end_angle,
+                    end_angle > start_angle,
+                )
+            else:
+                mid_angle = (start_angle + end_angle) / 2
+                path.arc(
+                    coords[i] + x,
+                    coords[i + 1] + y,
+                    cx + radius * cos(mid_angle),
+                    cy + radius * sin(mid_angle),
+                    coords[i + 2] + x,
+                    coords[i + 3] + y,
+                )
+            i += 9
+        else:
+            path.new_path()
+
+
 class ShxPath:
     """
     Example path code. Any class with these functions would work as well. When render is called on the ShxFont class
     the path is given particular useful segments.
+
+    Paths may define segments(codes, coords) to be given all the segments of a glyph in one call instead. codes is a
+    list with a type code for each segment, 0 new path, 1 move, 2 line, 3 arc and 4 center arc, and coords a flat list
+    with the coordinates of the segments in the order of the method arguments, radius and angles included. The lists
+    belong to the path once given.
+
+    Paths may also define center_arc(x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle, ccw). Such paths are given
+    the circle of each arc rather than a 3-point arc(): the start and end points, the center and radius, the start and
+    end angles in radians and whether the arc runs counterclockwise. end_angle - start_angle is the signed sweep.
     """
 
     def __init__(self):
@@ -166,12 +341,653 @@ class ShxPath:
         self.path.append([x0, y0, cx, cy, x1, y1])
 
 
+class ShxTransformPath:
+    """
+    Path which applies an affine matrix to every point before passing it on to another path.
+
+    Arcs stay arcs under rotation, translation, mirroring and uniform scaling. Other matrices, such as width factors
+    and oblique angles, turn circular arcs into elliptical ones so these arcs are split into short arcs which follow the
+    transformed ellipse.
+    """
+
+    def __init__(self, path, matrix):
+        self.path = path
+        self.matrix = matrix
+        a, b, c, d, e, f = matrix
+        scale = max(abs(a), abs(b), abs(c), abs(d), 1e-12)
+        self.conformal = (abs(a - d) < 1e-9 * scale and abs(b + c) < 1e-9 * scale) or (
+            abs(a + d) < 1e-9 * scale and abs(b - c) < 1e-9 * scale
+        )
+
+    def point(self, x, y):
+        a, b, c, d, e, f = self.matrix
+        return a * x + c * y + e, b * x + d * y + f
+
+    def new_path(self):
+        self.path.new_path()
+
+    def move(self, x, y):
+        self.path.move(*self.point(x, y))
+
+    def line(self, x0, y0, x1, y1):
+        self.path.line(*self.point(x0, y0), *self.point(x1, y1))
+
+    def arc(self, x0, y0, cx, cy, x1, y1):
+        if self.conformal:
+            self.path.arc(*self.point(x0, y0), *self.point(cx, cy), *self.point(x1, y1))
+            return
+        center = arc_center(x0, y0, cx, cy, x1, y1)
+        if center is None:
+            self.line(x0, y0, x1, y1)
+            return
+        ox, oy = center
+        radius = hypot(x0 - ox, y0 - oy)
+        start = atan2(y0 - oy, x0 - ox)
+        sweep = arc_sweep(x0, y0, cx, cy, x1, y1, ox, oy)
+        count = ceil(abs(sweep) / (tau / 32))
+        step = sweep / count
+        last = self.point(x0, y0)
+        for i in range(1, count + 1):
+            angle = start + step * (i - 0.5)
+            mx, my = self.point(ox + radius * cos(angle), oy + radius * sin(angle))
+            if i == count:
+                end = self.point(x1, y1)
+            else:
+                angle = start + step * i
+                end = self.point(ox + radius * cos(angle), oy + radius * sin(angle))
+            self.path.arc(*last, mx, my, *end)
+            last = end
+
+    def center_arc(self, x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle, ccw):
+        center_arc = getattr(self.path, "center_arc", None)
+        if center_arc is None or not self.conformal:
+            mid_angle = (start_angle + end_angle) / 2
+            self.arc(x0, y0, cx + radius * cos(mid_angle), cy + radius * sin(mid_angle), x1, y1)
+            return
+        a, b, c, d, e, f = self.matrix
+        rotation = atan2(b, a)
+        if a * d - b * c < 0:
+            # Mirrored, angles are reflected and the direction reverses.
+            start_angle = rotation - start_angle
+            end_angle = rotation - end_angle
+            ccw = not ccw
+        else:
+            start_angle += rotation
+            end_angle += rotation
+        center_arc(
+            *self.point(x0, y0),
+            *self.point(x1, y1),
+            *self.point(cx, cy),
+            radius * hypot(a, b),
+            start_angle,
+            end_angle,
+            ccw,
+        )
+
+
+class ShxGlyphPool:
+    """
+    Interns immutable bytes such as glyph programs, glyph names and recorded geometry by content. Fonts that share glyphs,
+    such as fonts derived from the same source, keep a single copy of each. Every holder acquires a reference with
+    intern() and gives it back with release(), content is dropped once no references are left.
+    """
+
+    def __init__(self):
+        self.references = 0  # References held, over all content.
+        self._entries = dict()  # Content to [interned bytes, reference count].
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return (
+            f"ShxGlyphPool(entries: {len(self._entries)}, references: {self.references}, "
+            f"size: {self.size}, saved: {self.saved})"
+        )
+
+    @property
+    def size(self):
+        """
+        Number of bytes used by the interned content.
+        """
+        return sum(getsizeof(data) for data, count in self._entries.values())
+
+    @property
+    def saved(self):
+        """
+        Number of bytes saved by sharing, compared to every reference holding its own copy.
+        """
+        return sum(getsizeof(data) * (count - 1) for data, count in self._entries.values())
+
+    def intern(self, data):
+        """
+        Acquires a reference to the interned copy of the data.
+
+        :param data: bytes
+        :return: bytes equal to data, shared by every holder of equal data.
+        """
+        entries = self._entries
+        entry = entries.get(data)
+        if entry is None:
+            entry = entries.setdefault(data, [data, 0])
+        entry[1] += 1
+        self.references += 1
+        return entry[0]
+
+    def release(self, data):
+        """
+        Gives back a reference acquired with intern().
+        """
+        entry = self._entries.get(data)
+        if entry is None:
+            return
+        entry[1] -= 1
+        self.references -= 1
+        if entry[1] <= 0:
+            del self._entries[data]
+
+    def release_all(self, items):
+        """
+        Gives back every reference in items.
+        """
+        for data in items:
+            self.release(data)
+
+
+GLYPH_POOL = ShxGlyphPool()  # Pool shared by all fonts and render caches unless they are given another.
+
+
+class ShxRenderResult:
+    """
+    Immutable compact recording of a render. Segment types are stored as bytes (0 new path, 1 move, 2 line, 3 arc,
+    4 center arc) and the coordinates as packed doubles relative to the start position of the render.
+    """
+
+    __slots__ = ("codes", "coords", "end")
+
+    def __init__(self, codes, coords, end):
+        self.codes = codes  # Segment type codes, bytes.
+        self.coords = coords  # Segment coordinates, packed doubles.
+        self.end = end  # Pen position after the render, relative to the start.
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def size(self):
+        """
+        Number of bytes used by the recorded segments.
+        """
+        return len(self.codes) + len(self.coords)
+
+    @staticmethod
+    def _three_point_arcs(codes, coords):
+        """
+        Rewrites the center arcs in codes into 3-point arcs through the middle of the arc, returns the new coordinates.
+        """
+        arcs = list()
+        i = 0
+        for k, code in enumerate(codes):
+            if code == 4:
+                x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle = coords[i : i + 9]
+                mid_angle = (start_angle + end_angle) / 2
+                arcs += (x0, y0, cx + radius * cos(mid_angle), cy + radius * sin(mid_angle), x1, y1)
+                codes[k] = 3
+                i += 9
+            else:
+                n = SEGMENT_LENGTHS[code]
+                arcs += coords[i : i + n]
+                i += n
+        return arcs
+
+    def replay(self, path, x=0.0, y=0.0):
+        """
+        Replays the recorded segments into the path, with the start of the render placed at x, y. Paths with
+        segments() are given the whole recording in one call, center arcs become 3-point arcs for paths without
+        center_arc().
+
+        :param path: path object receiving the segments, see ShxPath.
+        :param x: offset added to every x coordinate.
+        :param y: offset added to every y coordinate.
+        :return: pen position after the render
+        """
+        segments = getattr(path, "segments", None)
+        if segments is not None:
+            codes = list(self.codes)
+            coords = memoryview(self.coords).cast("d").tolist()
+            if getattr(path, "center_arc", None) is None and 4 in codes:
+                coords = self._three_point_arcs(codes, coords)
+            if x or y:
+                i = 0
+                for code in codes:
+                    # Center arcs end with radius and angles, which are not offset.
+                    for j in range(i, i + min(SEGMENT_LENGTHS[code], 6), 2):
+                        coords[j] += x
+                        coords[j + 1] += y
+                    i += SEGMENT_LENGTHS[code]
+            segments(codes, coords)
+            return self.end[0] + x, self.end[1] + y
+        replay_segments(path, self.codes, memoryview(self.coords).cast("d"), x, y)
+        return self.end[0] + x, self.end[1] + y
+
+
+class ShxRecordPath:
+    """
+    Path which records segments as type codes and flat coordinates, the form used by segments() and ShxRenderResult.
+    """
+
+    def __init__(self, center_arcs=True):
+        self.codes = list()
+        self.coords = list()  # Lists extend faster than arrays, they are packed once recording is done.
+        if not center_arcs:
+            # Hides center_arc() so arcs are recorded as 3-point arcs.
+            self.center_arc = None
+
+    def clear(self):
+        self.codes = list()
+        self.coords = list()
+
+    def segments(self, codes, coords):
+        self.codes.extend(codes)
+        self.coords.extend(coords)
+
+    def new_path(self):
+        self.codes.append(0)
+
+    def move(self, x, y):
+        self.codes.append(1)
+        self.coords += (x, y)
+
+    def line(self, x0, y0, x1, y1):
+        self.codes.append(2)
+        self.coords += (x0, y0, x1, y1)
+
+    def arc(self, x0, y0, cx, cy, x1, y1):
+        self.codes.append(3)
+        self.coords += (x0, y0, cx, cy, x1, y1)
+
+    def center_arc(self, x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle, ccw):
+        self.codes.append(4)
+        self.coords += (x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle)
+
+    def result(self, end):
+        return ShxRenderResult(bytes(self.codes), array("d", self.coords).tobytes(), end)
+
+
+class ShxRenderCache:
+    """
+    Least recently used cache of rendered strings. Results are keyed by font, text, font size and direction, rendered
+    once at the origin and replayed at any position. The oldest results are evicted once the recorded segments use
+    more than max_size bytes. Recorded segments are interned in the pool, equal renders in different fonts share them.
+    The cache holds no reference to the fonts, the results of a font are dropped when the font is collected.
+    """
+
+    def __init__(self, max_size=1 << 24, pool=GLYPH_POOL):
+        self.max_size = max_size  # Largest number of bytes of segments kept.
+        self.size = 0  # Bytes of segments currently kept.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = OrderedDict()
+        self._fonts = dict()  # Finalizer dropping the results of each font, by font id.
+        self._pool = pool
+        if pool is not None:
+            weakref.finalize(self, ShxRenderCache._release, pool, self._results)
+
+    @staticmethod
+    def _release(pool, results):
+        for result in results.values():
+            pool.release(result.codes)
+            pool.release(result.coords)
+
+    @staticmethod
+    def _drop_font(ref, font_id):
+        self = ref()
+        if self is None:
+            return
+        del self._fonts[font_id]
+        results = self._results
+        for key in [key for key in results if key[0] == font_id]:
+            result = results.pop(key)
+            self.size -= result.size
+            if self._pool is not None:
+                self._pool.release(result.codes)
+                self._pool.release(result.coords)
+
+    def __len__(self):
+        return len(self._results)
+
+    def __str__(self):
+        return (
+            f"ShxRenderCache(results: {len(self._results)}, size: {self.size}/{self.max_size}, "
+            f"hits: {self.hits}, misses: {self.misses}, evictions: {self.evictions})"
+        )
+
+    def clear(self):
+        """
+        Removes all results, the statistics are kept.
+        """
+        if self._pool is not None:
+            self._release(self._pool, self._results)
+        self._results.clear()
+        for finalizer in self._fonts.values():
+            finalizer.detach()
+        self._fonts.clear()
+        self.size = 0
+
+    def result(self, font, text, horizontal=True, font_size=12.0):
+        """
+        Gets the recorded render of the text, rendering it on a miss.
+
+        :param font: ShxFont, fonts are told apart by identity and codec.
+        :param text: text to render.
+        :param horizontal: horizontal or vertical text, for dual mode fonts.
+        :param font_size: height of capital letters.
+        :return: ShxRenderResult
+        """
+        key = (id(font), font.codec, text, font_size, horizontal)
+        results = self._results
+        try:
+            result = results[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            results.move_to_end(key)
+            return result
+        self.misses += 1
+        recorder = ShxRecordPath()
+        # Render at the origin without moving the pen of the font's own renders.
+        pen = font._x, font._y, font._last_x, font._last_y
+        try:
+            font.render(recorder, text, horizontal=horizontal, font_size=font_size, x=0.0, y=0.0)
+            result = recorder.result((font._x, font._y))
+        finally:
+            font._x, font._y, font._last_x, font._last_y = pen
+        if result.size <= self.max_size:
+            if key[0] not in self._fonts:
+                self._fonts[key[0]] = weakref.finalize(font, ShxRenderCache._drop_font, weakref.ref(self), key[0])
+            pool = self._pool
+            if pool is not None:
+                result = ShxRenderResult(pool.intern(result.codes), pool.intern(result.coords), result.end)
+            results[key] = result
+            self.size += result.size
+            while self.size > self.max_size:
+                _, evicted = results.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+                if pool is not None:
+                    pool.release(evicted.codes)
+                    pool.release(evicted.coords)
+        return result
+
+    def render(self, font, path, text, horizontal=True, font_size=12.0, x=0.0, y=0.0, matrix=None):
+        """
+        Renders the text into the path, as ShxFont.render() does, replaying the cached result where there is one.
+
+        :param font: ShxFont
+        :param path: path object receiving the segments, see ShxPath.
+        :param text: text to render.
+        :param horizontal: horizontal or vertical text, for dual mode fonts.
+        :param font_size: height of capital letters.
+        :param x: start x position.
+        :param y: start y position.
+        :param matrix: affine matrix (a, b, c, d, e, f) applied to every point, see text_matrix().
+        :return: pen position after the text
+        """
+        result = self.result(font, text, horizontal, font_size)
+        if matrix is None:
+            return result.replay(path, x, y)
+        a, b, c, d, e, f = matrix
+        segments = getattr(path, "segments", None)
+        buffer = None
+        if segments is not None:
+            # The transformed segments are buffered and still handed over in one call.
+            buffer = ShxRecordPath(center_arcs=getattr(path, "center_arc", None) is not None)
+            path = buffer
+        path = ShxTransformPath(path, (a, b, c, d, e + x, f + y))
+        result.replay(path)
+        if buffer is not None and buffer.codes:
+            segments(buffer.codes, buffer.coords)
+        return path.point(*result.end)
+
+
+class ShxHitIndex:
+    """
+    Index of rendered characters, for finding the characters at a position. Rendering with hits=index records for each
+    character the range of segments it gave the path and their bounds. Characters are numbered in the order they are
+    rendered, over all renders into the index.
+
+    Point and rectangle queries search R-trees packed by position with sort-tile-recursive packing. Characters added
+    since the last query are packed into a new tree and trees of similar size are merged, so adding text never rebuilds
+    the whole index and a query searches a logarithmic number of trees.
+    """
+
+    FANOUT = 8  # Children of each tree node.
+
+    def __init__(self):
+        self.ranges = list()  # First and end segment of each character.
+        self.bounds = list()  # min_x, min_y, max_x, max_y of each character, None if nothing was drawn.
+        self.count = 0  # Segments recorded.
+        self._trees = list()  # Leaf entries and root of each packed tree, largest first.
+        self._packed = 0  # Characters packed into the trees.
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def add(self, codes, coords):
+        """
+        Adds a character drawn with the given segments, see ShxPath.segments.
+        """
+        min_x = min_y = float("inf")
+        max_x = max_y = -float("inf")
+        i = 0
+        for code in codes:
+            if code == 2:
+                xs = coords[i], coords[i + 2]
+                ys = coords[i + 1], coords[i + 3]
+            elif code == 3:
+                xs, ys = self._arc_extremes(*coords[i : i + 6])
+            elif code == 4:
+                x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle = coords[i : i + 9]
+                xs, ys = self._circle_extremes(cx, cy, radius, start_angle, end_angle - start_angle)
+                xs += (x0, x1)
+                ys += (y0, y1)
+            else:
+                # Moves and path starts draw nothing.
+                i += SEGMENT_LENGTHS[code]
+                continue
+            i += SEGMENT_LENGTHS[code]
+            min_x = min(min_x, *xs)
+            min_y = min(min_y, *ys)
+            max_x = max(max_x, *xs)
+            max_y = max(max_y, *ys)
+        self.ranges.append((self.count, self.count + len(codes)))
+        self.bounds.append(None if isinf(min_x) else (min_x, min_y, max_x, max_y))
+        self.count += len(codes)
+
+    @staticmethod
+    def _circle_extremes(cx, cy, radius, start_angle, sweep):
+        """
+        Points of the arc furthest along the axes, besides its ends.
+        """
+        xs = list()
+        ys = list()
+        if sweep < 0:
+            start_angle += sweep
+            sweep = -sweep
+        quarter = tau / 4
+        k = ceil(start_angle / quarter)
+        while k * quarter <= start_angle + sweep:
+            side = k % 4
+            if side == 0:
+                xs.append(cx + radius)
+            elif side == 1:
+                ys.append(cy + radius)
+            elif side == 2:
+                xs.append(cx - radius)
+            else:
+                ys.append(cy - radius)
+            k += 1
+        return xs, ys
+
+    def _arc_extremes(self, x0, y0, cx, cy, x1, y1):
+        xs = [x0, x1]
+        ys = [y0, y1]
+        center = arc_center(x0, y0, cx, cy, x1, y1)
+        if center is not None:
+            ox, oy = center
+            sweep = arc_sweep(x0, y0, cx, cy, x1, y1, ox, oy)
+            ex, ey = self._circle_extremes(ox, oy, hypot(x0 - ox, y0 - oy), atan2(y0 - oy, x0 - ox), sweep)
+            xs += ex
+            ys += ey
+        return xs, ys
+
+    def segment_range(self, start, end=None):
+        """
+        Segments drawn by the characters from start up to end.
+
+        :param start: first character index.
+        :param end: character index after the last, defaults to the character after start.
+        :return: range of segment indexes
+        """
+        if end is None:
+            end = start + 1
+        if end <= start:
+            return range(0)
+        return range(self.ranges[start][0], self.ranges[end - 1][1])
+
+    @classmethod
+    def _pack(cls, entries):
+        """
+        Packs (min_x, min_y, max_x, max_y, item) entries into an R-tree level by level, returns the root node. Entries
+        are sorted into vertical slices by center x, each slice by center y, and cut into nodes of FANOUT entries.
+        """
+        fanout = cls.FANOUT
+        nodes = entries
+        while len(nodes) > 1:
+            count = ceil(len(nodes) / fanout)
+            slice_size = ceil(count / ceil(sqrt(count))) * fanout
+            nodes = sorted(nodes, key=lambda n: n[0] + n[2])
+            parents = list()
+            for i in range(0, len(nodes), slice_size):
+                column = sorted(nodes[i : i + slice_size], key=lambda n: n[1] + n[3])
+                for j in range(0, len(column), fanout):
+                    children = column[j : j + fanout]
+                    parents.append(
+                        (
+                            min(n[0] for n in children),
+                            min(n[1] for n in children),
+                            max(n[2] for n in children),
+                            max(n[3] for n in children),
+                            children,
+                        )
+                    )
+            nodes = parents
+        return nodes[0]
+
+    def _update(self):
+        """
+        Packs the characters added since the last query into a tree, merging it with trees no larger than it.
+        """
+        bounds = self.bounds
+        entries = [(*bounds[i], i) for i in range(self._packed, len(bounds)) if bounds[i] is not None]
+        self._packed = len(bounds)
+        if not entries:
+            return
+        trees = self._trees
+        while trees and len(trees[-1][0]) <= len(entries):
+            entries = trees.pop()[0] + entries
+        trees.append((entries, self._pack(entries)))
+
+    def rect(self, min_x, min_y, max_x, max_y):
+        """
+        Characters whose bounds touch the rectangle.
+
+        :return: list of character indexes in render order
+        """
+        if self._packed != len(self.bounds):
+            self._update()
+        found = list()
+        for _, root in self._trees:
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if node[0] > max_x or node[2] < min_x or node[1] > max_y or node[3] < min_y:
+                    continue
+                item = node[4]
+                if isinstance(item, list):
+                    stack += item
+                else:
+                    found.append(item)
+        found.sort()
+        return found
+
+    def point(self, x, y, tolerance=0.0):
+        """
+        Characters whose bounds contain the point, give or take the tolerance.
+
+        :return: list of character indexes in render order
+        """
+        return self.rect(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+
+
 class ShxFontParseError(Exception):
     """
     Exception thrown if unable to pop a value from the given codes or other suspected parsing errors.
     """
 
 
+class ShxGlyphInfo:
+    """
+    Static analysis of a single glyph program, as produced by ShxFont.analyze().
+
+    The values for stack usage and cost include the subshapes the glyph draws. Glyphs that can reach a subshape
+    cycle have an infinite cost since rendering them would never terminate.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.subshapes = list()  # Subshape indexes referenced directly by this glyph, in program order.
+        self.missing = list()  # Referenced subshapes which do not exist in the font.
+        self.cycle = False  # Glyph reaches itself through its subshapes.
+        self.truncated = False  # Glyph program ends in the middle of a command.
+        self.zero_factor = False  # Glyph divides or multiplies the vector length by 0.
+        self.stack_delta = 0  # Net change of position stack depth after the glyph is drawn.
+        self.stack_min = 0  # Lowest stack depth relative to the start, negative values are underflows.
+        self.stack_max = 0  # Highest stack depth relative to the start.
+        self.cost = 0  # Estimated render cost in executed commands.
+
+    def __str__(self):
+        return f"ShxGlyphInfo({self.index}, cost={self.cost}, errors={self.errors})"
+
+    @property
+    def errors(self):
+        """
+        List of problems found in this glyph. Empty if the glyph is safe to render.
+        """
+        errors = list()
+        if self.truncated:
+            errors.append("truncated")
+        if self.zero_factor:
+            errors.append("zero vector factor")
+        if self.missing:
+            errors.append("missing subshape")
+        if self.cycle:
+            errors.append("subshape cycle")
+        if self.stack_min < 0:
+            errors.append("stack underflow")
+        if self.stack_max >= STACK_DEPTH:
+            errors.append("stack overflow")
+        if self.stack_delta != 0:
+            errors.append("stack imbalance")
+        return errors
+
+    @property
+    def valid(self):
+        return not self.errors
+
+
 class ShxFont:
     """
     This class performs the parsing of the three major types of .SHX fonts. Composing them into specific glyphs which
@@ -179,21 +995,30 @@ class ShxFont:
     on the font which create the vector path.
     """
 
-    def __init__(self, filename, debug=False):
+    def __init__(self, filename, debug=False, codec=None, pool=GLYPH_POOL):
         self.format = None  # format (usually AutoCAD-86)
         self.type = None  # Font type: shapes, bigfont, unifont
         self.version = None  # Font file version (usually 1.0).
         self.glyphs = dict()  # Glyph dictionary
+        self.names = dict()  # Glyph names by glyph index, as bytes
+        self.changes = list()  # Bigfont escape code ranges (start, end)
         self.font_name = None  # Parsed font name.
         self.above = None  # Distance above baseline for capital letters.
         self.below = None  # Distance below baseline for lowercase letters
         self.modes = None  # 0 Horizontal Only, 2 Dual mode (Horizontal or Vertical)
+        self.info_end = b"\x00"  # Font information bytes after the modes, extended bigfonts keep the width here.
         self.encoding = False  # 0 unicode, 1 packed multibyte, 2 shape file
         self.embedded = False  # 0 font can be embedded, 1 font cannot be embedded, 2 embedding is read-only
+        self.codec = codec  # Encoding of the glyph indexes, such as "cp932" or "gbk" for bigfonts. None for unicode.
 
         self._debug = debug
         self._code = None
+        self._signed = None
+        self._pc = 0
+        self._frames = []
         self._path = None
+        self._center_arc = None
+        self._buffer = None
         self._skip = False
         self._pen = False
         self._horizontal = True
@@ -204,8 +1029,15 @@ class ShxFont:
         self._last_y = 0
         self._scale = 1
         self._stack = []
+        self._analysis = None
+        self._translations = dict()
+        self._pool = pool
+        self._interned = list()  # Glyph data acquired from the pool, given back when the font is collected.
+        if pool is not None:
+            weakref.finalize(self, pool.release_all, self._interned)
 
-        self._parse(filename)
+        if filename is not None:
+            self._parse(filename)
 
     def __str__(self):
         return f'{self.type}("{self.font_name}", {self.version}, glyphs: {len(self.glyphs)})'
@@ -234,6 +1066,70 @@ class ShxFont:
         self.version = parts[2]
         f.read(2)
 
+    @staticmethod
+    def _split_name(data):
+        """
+        Glyph and font information entries start with a null terminated name.
+
+        :return: name bytes, remaining data
+        """
+        find = data.find(b"\x00")
+        if find == -1:
+            return b"", data
+        return data[:find], data[find + 1:]
+
+    def _parse_info(self, data):
+        """
+        Parses the font information entry (glyph 0) of shapes and bigfont files.
+        """
+        if self.font_name is not None:
+            raise ShxFontParseError("Double-initializing glyph data detected")
+        name, data = self._split_name(data)
+        if len(data) < 3:
+            raise ShxFontParseError("Font information is incomplete.")
+        if self.type == "shapes":
+            try:
+                self.font_name = name.decode("utf-8")
+            except UnicodeDecodeError as e:
+                raise ShxFontParseError(f"Font name did not capture valid text. {name}") from e
+        else:
+            self.font_name = name.decode("latin-1")
+        self.above = data[0]  # vector lengths above baseline
+        self.below = data[1]  # vector lengths below baseline
+        # 0 - Horizontal, 2 - dual. 0x0E command only when mode=2
+        self.modes = data[2]
+        self.info_end = bytes(data[3:])
+
+    def _parse_glyph(self, index, data):
+        """
+        Stores glyph data, splitting off the glyph name. Shapes fonts also make the glyph available by its name.
+        """
+        name, data = self._split_name(data)
+        data = self._intern(data)
+        if name:
+            name = self._intern(name)
+            self.names[index] = name
+            if self.type == "shapes":
+                for c in name:
+                    if ord("A") <= c <= ord("Z") or ord("0") <= c <= ord("9") or c == ord(" ") or c == ord("&"):
+                        continue
+                    if self._debug:
+                        print(f"{name} is not a valid glyph name.")
+                    break
+                else:
+                    self.glyphs[name.decode()] = data
+        self.glyphs[index] = data
+
+    def _intern(self, data):
+        """
+        Gets the copy of data shared with other fonts through the pool.
+        """
+        if self._pool is None:
+            return data
+        data = self._pool.intern(data)
+        self._interned.append(data)
+        return data
+
     def _parse_shapes(self, f):
         start = read_int_16le(f)
         end = read_int_16le(f)
@@ -247,53 +1143,24 @@ class ShxFont:
             glyph_ref.append((index, length))
 
         for index, length in glyph_ref:
+            data = f.read(length)
+            if len(data) != length:
+                raise ShxFontParseError("Glyph length did not exist in file.")
             if index == 0:
-                if self.font_name is not None:
-                    raise ShxFontParseError("Double-initializing glyph data detected")
-                self.font_name = read_string(f)
-                self.above = read_int_8(f)  # vector lengths above baseline
-                self.below = read_int_8(f)  # vector lengths below baseline
-                # 0 - Horizontal, 2 - dual. 0x0E command only when mode=2
-                self.modes = read_int_8(f)
-                # end = read_int_16le(f)
+                self._parse_info(data)
             else:
-                read = f.read(length)
-                data = read
-                if len(data) != length:
-                    raise ShxFontParseError("Glyph length did not exist in file.")
-                if data[0] == 0 and data[1] == 0:
-                    data = data[2:]
-                elif data[0] == 0:
-                    data = data[1:]
-                    find = data.find(b"\x00")
-                    if find != -1:
-                        name = data[:find]
-
-                        for c in name:
-                            if ord("A") <= c <= ord("Z") or ord("0") <= c <= ord("9") or c == ord(" ") or c == ord("&"):
-                                continue
-                            name = None
-                            break
-                        if name is not None:
-                            data = data[find+1:]
-                            name = name.decode()
-                            self.glyphs[name] = data
-                        else:
-                            if self._debug:
-                                print(f"{data} did not contain a name.")
-                self.glyphs[index] = data
+                self._parse_glyph(index, data)
 
     def _parse_bigfont(self, f):
+        length = read_int_16le(f)  # Length of each glyph reference.
         count = read_int_16le(f)
-        length = read_int_16le(f)
-        changes = list()
         change_count = read_int_16le(f)
         if self._debug:
             print(f"Parsing bigfont: count={count}, length={length}, change_count={change_count}")
         for i in range(change_count):
             start = read_int_16le(f)
             end = read_int_16le(f)
-            changes.append((start, end))
+            self.changes.append((start, end))
 
         glyph_ref = list()
         for i in range(count):
@@ -303,72 +1170,479 @@ class ShxFont:
             glyph_ref.append((index, length, offset))
 
         for index, length, offset in glyph_ref:
+            if length == 0:
+                # Unused reference.
+                continue
             f.seek(offset, 0)
+            data = f.read(length)
+            if len(data) != length:
+                raise ShxFontParseError("Glyph length did not exist in file.")
             if index == 0:
-                # self.font_name = read_string(f)
-                self.above = read_int_8(f)  # vector lengths above baseline
-                self.below = read_int_8(f)  # vector lengths below baseline
-                # 0 - Horizontal, 2 - dual. 0x0E command only when mode=2
-                self.modes = read_int_8(f)
-
+                self._parse_info(data)
             else:
-                self.glyphs[index] = f.read(length)
+                self._parse_glyph(index, data)
 
     def _parse_unifont(self, f):
         count = read_int_32le(f)
         length = read_int_16le(f)
-        f.seek(5)
-        self.font_name = read_string(f)
-        self.above = read_int_8(f)
-        self.below = read_int_8(f)
-        self.mode = read_int_8(f)
-        self.encoding = read_int_8(f)
-        self.embedded = read_int_8(f)
-        ignore = read_int_8(f)
+        name, data = self._split_name(f.read(length))
+        if len(data) < 5:
+            raise ShxFontParseError("Font information is incomplete.")
+        self.font_name = name.decode("latin-1")
+        self.above = data[0]
+        self.below = data[1]
+        self.modes = data[2]
+        self.encoding = data[3]
+        self.embedded = data[4]
         if self._debug:
             print(f"Parsing unifont: name={self.font_name}, count={count}, length={length}")
         for i in range(count - 1):
             index = read_int_16le(f)
             length = read_int_16le(f)
-            self.glyphs[index] = f.read(length)
+            data = f.read(length)
+            if index is None or len(data) != length:
+                raise ShxFontParseError("Glyph length did not exist in file.")
+            self._parse_glyph(index, data)
+
+    def write(self, filename):
+        """
+        Writes the font to an .SHX file in the format given by its type. Glyph names and bigfont escape ranges are
+        preserved, so the written file parses back into an equal font.
+
+        :param filename: file to write.
+        :return:
+        """
+        if self.type == "shapes":
+            write_glyphs = self._write_shapes
+        elif self.type == "bigfont":
+            write_glyphs = self._write_bigfont
+        elif self.type == "unifont":
+            write_glyphs = self._write_unifont
+        else:
+            raise ShxFontParseError(f"{self.type} is not a valid shx file type.")
+        with open(filename, "bw") as f:
+            self._write_header(f)
+            write_glyphs(f)
+
+    def _write_header(self, f):
+        f.write(f"{self.format} {self.type} {self.version}\r\n\x1a".encode("utf-8"))
+
+    def _glyph_entries(self):
+        """
+        Glyph file entries in index order. Each entry is the null terminated glyph name followed by the glyph data.
+
+        :return: list of (index, data)
+        """
+        return [
+            (index, self.names.get(index, b"") + b"\x00" + bytes(self.glyphs[index]))
+            for index in sorted(i for i in self.glyphs if isinstance(i, int))
+        ]
+
+    def _info_entry(self):
+        """
+        Font information entry (glyph 0) of shapes and bigfont files.
+        """
+        name = (self.font_name or "").encode("utf-8" if self.type == "shapes" else "latin-1")
+        return name + b"\x00" + bytes((self.above or 0, self.below or 0, self.modes or 0)) + self.info_end
+
+    def _write_shapes(self, f):
+        entries = self._glyph_entries()
+        if self.font_name is not None:
+            # Shape libraries do not have font information.
+            entries.insert(0, (0, self._info_entry()))
+        write_int_16le(f, entries[0][0] if entries else 0)
+        write_int_16le(f, entries[-1][0] if entries else 0)
+        write_int_16le(f, len(entries))
+        for index, data in entries:
+            write_int_16le(f, index)
+            write_int_16le(f, len(data))
+        for index, data in entries:
+            f.write(data)
+        f.write(b"EOF")
+
+    def _write_bigfont(self, f):
+        entries = [(0, self._info_entry())] + self._glyph_entries()
+        write_int_16le(f, 8)  # Length of each glyph reference.
+        write_int_16le(f, len(entries))
+        write_int_16le(f, len(self.changes))
+        for start, end in self.changes:
+            write_int_16le(f, start)
+            write_int_16le(f, end)
+        offset = f.tell() + 8 * len(entries)
+        for index, data in entries:
+            write_int_16le(f, index)
+            write_int_16le(f, len(data))
+            write_int_32le(f, offset)
+            offset += len(data)
+        for index, data in entries:
+            f.write(data)
+
+    def _write_unifont(self, f):
+        entries = self._glyph_entries()
+        info = (self.font_name or "").encode("latin-1") + b"\x00"
+        info += bytes(
+            (
+                self.above or 0,
+                self.below or 0,
+                self.modes or 0,
+                int(self.encoding or 0),
+                int(self.embedded or 0),
+                0,
+            )
+        )
+        write_int_32le(f, len(entries) + 1)
+        write_int_16le(f, len(info))
+        f.write(info)
+        for index, data in entries:
+            write_int_16le(f, index)
+            write_int_16le(f, len(data))
+            f.write(data)
+
+    def subset(self, text):
+        """
+        Creates a new font containing only the glyphs needed to render the given text, along with every subshape those
+        glyphs draw. Unknown characters are ignored.
+
+        :param text: string or iterable of characters and glyph indexes to keep.
+        :return: ShxFont subset of this font.
+        """
+        analysis = self.analyze()
+        translation = self.translation()
+        todo = [translation.get(ord(c), ord(c)) if isinstance(c, str) else c for c in text]
+        keep = set()
+        while todo:
+            index = todo.pop()
+            if index in keep or index not in self.glyphs:
+                continue
+            keep.add(index)
+            todo.extend(analysis[index].subshapes)
+
+        font = ShxFont(None, debug=self._debug, codec=self.codec, pool=self._pool)
+        font.format = self.format
+        font.type = self.type
+        font.version = self.version
+        font.font_name = self.font_name
+        font.above = self.above
+        font.below = self.below
+        font.modes = self.modes
+        font.info_end = self.info_end
+        font.encoding = self.encoding
+        font.embedded = self.embedded
+        font.changes = list(self.changes)
+        for index in sorted(keep):
+            data = font.glyphs[index] = font._intern(self.glyphs[index])
+            name = self.names.get(index)
+            if name is not None:
+                font.names[index] = font._intern(name)
+                if name.decode("latin-1") in self.glyphs:
+                    font.glyphs[name.decode("latin-1")] = data
+        return font
+
+    def translation(self, codec=None):
+        """
+        Table of unicode code points to glyph indexes. Bigfont glyphs are indexed by the multibyte code of the character
+        in the font's encoding, such as Shift-JIS or GBK, where the first byte of double byte codes is within one of the
+        escape code ranges in changes. The table is built once for each codec.
+
+        :param codec: python codec of the glyph indexes, defaults to the codec of the font.
+        :return: dictionary of code points to glyph indexes, empty without a codec.
+        """
+        if codec is None:
+            codec = self.codec
+        try:
+            return self._translations[codec]
+        except KeyError:
+            pass
+        table = dict()
+        if codec is not None:
+            escapes = set()
+            for start, end in self.changes:
+                escapes.update(range(start, end + 1))
+            for index in self.glyphs:
+                if isinstance(index, str):
+                    continue
+                lead = index >> 8
+                if lead:
+                    if lead not in escapes:
+                        continue
+                    code = bytes((lead, index & 0xFF))
+                elif index in escapes:
+                    continue
+                else:
+                    code = bytes((index,))
+                try:
+                    character = code.decode(codec)
+                except UnicodeDecodeError:
+                    continue
+                if len(character) == 1:
+                    table.setdefault(ord(character), index)
+        self._translations[codec] = table
+        return table
+
+    def _subshape_argument(self, code, pc):
+        """
+        Decodes the subshape reference of a DRAW_SUBSHAPE command whose arguments start at pc.
+
+        :return: subshape index, number of argument bytes
+        """
+        if self.type == "unifont":
+            return int_16be(code[pc:pc + 2]) if pc + 2 <= len(code) else None, 2
+        subshape = code[pc] if pc < len(code) else None
+        if subshape == 0 and self.type == "bigfont":
+            # Extended bigfont subshape: index, origin_x, origin_y, width, height.
+            return int_16be(code[pc + 1:pc + 3]) if pc + 3 <= len(code) else None, 7
+        return subshape, 1
+
+    def _analyze_glyph(self, index, code):
+        """
+        Decodes a single glyph program without drawing it. Records the local cost, the direct subshape references and
+        the sequence of stack events which are resolved once the subshapes are analyzed.
+
+        :return: ShxGlyphInfo, list of (command, subshape) stack events
+        """
+        info = ShxGlyphInfo(index)
+        events = list()
+        pc = 0
+        end = len(code)
+        while pc < end:
+            b = code[pc]
+            pc += 1
+            info.cost += 1
+            if b & 0xF0:
+                continue
+            if b == END_OF_SHAPE:
+                # Like the interpreter, skip the data up to the next null and carry on.
+                while pc < end:
+                    pc += 1
+                    if code[pc - 1] == 0:
+                        break
+            elif b in (DIVIDE_VECTOR, MULTIPLY_VECTOR):
+                if pc < end and code[pc] == 0:
+                    info.zero_factor = True
+                pc += 1
+            elif b in (PUSH_STACK, POP_STACK):
+                events.append((b, None))
+            elif b == DRAW_SUBSHAPE:
+                subshape, length = self._subshape_argument(code, pc)
+                pc += length
+                if subshape is not None:
+                    info.subshapes.append(subshape)
+                    events.append((b, subshape))
+            elif b in (XY_DISPLACEMENT, OCTANT_ARC):
+                pc += 2
+            elif b == BULGE_ARC:
+                pc += 3
+            elif b == FRACTIONAL_ARC:
+                pc += 5
+            elif b in (POLY_XY_DISPLACEMENT, POLY_BULGE_ARC):
+                while pc + 2 <= end and (code[pc] or code[pc + 1]):
+                    pc += 3 if b == POLY_BULGE_ARC else 2
+                    info.cost += 1
+                pc += 2
+        if pc > end:
+            info.truncated = True
+        return info, events
+
+    def analyze(self):
+        """
+        Statically analyzes every glyph in the font in one pass. Builds the subshape dependency graph and checks for
+        subshape cycles, missing subshapes, position stack errors and truncated glyphs. Estimated render costs include
+        the cost of all drawn subshapes.
+
+        The results are memoized, later calls return the same dictionary.
+
+        :return: dictionary of glyph index to ShxGlyphInfo
+        """
+        if self._analysis is not None:
+            return self._analysis
+        analysis = dict()
+        events = dict()
+        for index, code in self.glyphs.items():
+            analysis[index], events[index] = self._analyze_glyph(index, code)
+
+        # Iterative depth first search, subshapes are resolved before the glyphs which draw them.
+        done = set()
+        for root in analysis:
+            if root in done:
+                continue
+            active = {root}
+            todo = [(root, iter(analysis[root].subshapes))]
+            while todo:
+                index, subshapes = todo[-1]
+                info = analysis[index]
+                for subshape in subshapes:
+                    if subshape not in analysis:
+                        if subshape not in info.missing:
+                            info.missing.append(subshape)
+                    elif subshape in active:
+                        info.cycle = True
+                        analysis[subshape].cycle = True
+                    elif subshape not in done:
+                        active.add(subshape)
+                        todo.append((subshape, iter(analysis[subshape].subshapes)))
+                        break
+                else:
+                    todo.pop()
+                    active.discard(index)
+                    done.add(index)
+                    self._resolve_glyph(info, events[index], analysis, done)
+        self._analysis = analysis
+        return analysis
+
+    @staticmethod
+    def _resolve_glyph(info, events, analysis, done):
+        """
+        Folds the analysis of resolved subshapes into the glyph which draws them.
+        """
+        depth = 0
+        for command, subshape in events:
+            if command == PUSH_STACK:
+                depth += 1
+                info.stack_max = max(info.stack_max, depth)
+            elif command == POP_STACK:
+                depth -= 1
+                info.stack_min = min(info.stack_min, depth)
+            elif subshape in done:
+                sub = analysis[subshape]
+                info.cycle |= sub.cycle
+                info.truncated |= sub.truncated
+                info.zero_factor |= sub.zero_factor
+                for missing in sub.missing:
+                    if missing not in info.missing:
+                        info.missing.append(missing)
+                info.stack_min = min(info.stack_min, depth + sub.stack_min)
+                info.stack_max = max(info.stack_max, depth + sub.stack_max)
+                depth += sub.stack_delta
+                info.cost += sub.cost
+        info.stack_delta = depth
+        if info.cycle:
+            info.cost = float("inf")
 
     def pop(self):
+        """
+        Reads the next byte of the glyph program currently being rendered.
+        """
         try:
-            return self._code.pop()
-        except IndexError as e:
+            b = self._code[self._pc]
+        except (IndexError, TypeError) as e:
             raise ShxFontParseError("No codes to pop()") from e
+        self._pc += 1
+        return b
 
-    def render(self, path, text, horizontal=True, font_size=12.0):
-        if self.above is None:
-            self.above = 1
-        self._scale = font_size / self.above
+    def render(self, path, text, horizontal=True, font_size=12.0, x=None, y=None, matrix=None, hits=None):
+        """
+        Renders the text into the given path. Without a position the text continues from where the previous render
+        ended. The pen is kept in path coordinates, a render with a matrix places its text origin at the pen and leaves
+        the pen at the transformed end of the text.
+
+        :param path: path object receiving the segments, see ShxPath.
+        :param text: text to render. Fonts with a codec find the glyph of each character through translation().
+        :param horizontal: horizontal or vertical text, for dual mode fonts.
+        :param font_size: height of capital letters.
+        :param x: start x position, the pen is moved to the text origin which is placed here.
+        :param y: start y position.
+        :param matrix: affine matrix (a, b, c, d, e, f) applied to every point as it is produced, see text_matrix().
+        :param hits: ShxHitIndex recording the segments and bounds of every character.
+        :return:
+        """
+        self._scale = font_size / (self.above or 1)
         self._horizontal = horizontal
+        if x is not None or y is not None:
+            x = x or 0.0
+            y = y or 0.0
+        elif matrix is not None:
+            x = self._x
+            y = self._y
+        if matrix is not None:
+            # The text is drawn around its own origin, the matrix moves that origin to the start position.
+            self._x = self._last_x = 0.0
+            self._y = self._last_y = 0.0
+            a, b, c, d, e, f = matrix
+            matrix = a, b, c, d, e + x, f + y
+        elif x is not None:
+            self._x = self._last_x = x
+            self._y = self._last_y = y
+        target = path
+        segments = getattr(path, "segments", None)
+        buffer = None
+        if segments is not None or hits is not None:
+            # Segments are buffered and handed over a glyph at a time.
+            buffer = ShxRecordPath(center_arcs=getattr(path, "center_arc", None) is not None)
+            path = buffer
+        if matrix is not None:
+            path = ShxTransformPath(path, matrix)
         self._path = path
+        self._center_arc = getattr(path, "center_arc", None)
+        self._buffer = buffer if matrix is None else None
+        translation = self.translation() if self.codec is not None else None
         for letter in text:
             self._letter = letter
+            index = ord(letter)
+            if translation is not None:
+                index = translation.get(index, index)
             try:
-                self._code = bytearray(reversed(self.glyphs[ord(letter)]))
+                glyph = self.glyphs[index]
             except KeyError:
                 # Letter is not found.
+                if hits is not None:
+                    hits.add((), ())
                 continue
             self._pen = True
-            while self._code:
-                try:
-                    self._parse_code()
-                except IndexError as e:
-                    raise ShxFontParseError("Stack Error during render.") from e
+            try:
+                self._execute(glyph)
+            except IndexError as e:
+                raise ShxFontParseError("Stack Error during render.") from e
             self._skip = False
+            if buffer is None:
+                continue
+            if hits is not None:
+                hits.add(buffer.codes, buffer.coords)
+            if buffer.codes:
+                if segments is not None:
+                    segments(buffer.codes, buffer.coords)
+                else:
+                    replay_segments(target, buffer.codes, buffer.coords)
+                buffer.clear()
+        if matrix is not None:
+            self._x, self._y = path.point(self._x, self._y)
+            self._last_x, self._last_y = self._x, self._y
         if self._debug:
             print(f"Render Complete.\n\n\n")
 
-    def _parse_code(self):
-        b = self.pop()
-        direction = b & 0x0F
-        length = (b & 0xF0) >> 4
-        if length == 0:
-            self._parse_code_special(direction)
-        else:
-            self._parse_code_length(direction, length)
+    def _execute(self, glyph):
+        """
+        Executes a glyph program in place. The glyph bytes are read through memoryviews at the program counter, drawn
+        subshapes push a (code, signed, pc) frame onto the call stack and return to it when they end.
+
+        :param glyph: glyph program bytes
+        :return:
+        """
+        self._code = memoryview(glyph)
+        self._signed = self._code.cast("b")
+        self._pc = 0
+        frames = self._frames = []
+        specials = self._specials
+        code = self._code
+        end = len(code)
+        while True:
+            pc = self._pc
+            if pc >= end:
+                if not frames:
+                    break
+                self._code, self._signed, self._pc = frames.pop()
+                code = self._code
+                end = len(code)
+                continue
+            b = code[pc]
+            self._pc = pc + 1
+            if b & 0xF0:
+                self._parse_code_length(b & 0x0F, b >> 4)
+            else:
+                specials[b](self)
+                if self._code is not code:
+                    # Subshape was called.
+                    code = self._code
+                    end = len(code)
 
     def _parse_code_length(self, direction, length):
         """
@@ -385,82 +1659,52 @@ class ShxFont:
         if self._skip:
             self._skip = False
             return
-        if direction in (2, 1, 0, 0xF, 0xE):
-            dx = 1.0
-        elif direction in (3, 0xD):
-            dx = 0.5
-        elif direction in (4, 0xC):
-            dx = 0.0
-        elif direction in (5, 0xB):
-            dx = -0.5
-        else:  # (6, 7, 8, 9, 0xa):
-            dx = -1.0
-        if direction in (6, 5, 4, 3, 2):
-            dy = 1.0
-        elif direction in (7, 1):
-            dy = 0.5
-        elif direction in (8, 0):
-            dy = 0.0
-        elif direction in (9, 0xF):
-            dy = -0.5
-        else:  # (0xa, 0xb, 0xc, 0xd, 0xe, 0xf):
-            dy = -1.0
+        dx, dy = DIRECTION_VECTORS[direction]
         self._x += dx * length * self._scale
         self._y += dy * length * self._scale
-        if self._pen:
+        buffer = self._buffer
+        if buffer is not None:
+            # Most segments are length direction codes, these are written to the segment buffer directly.
+            if self._pen:
+                buffer.codes.append(2)
+                buffer.coords += (self._last_x, self._last_y, self._x, self._y)
+            else:
+                buffer.codes.append(1)
+                buffer.coords += (self._x, self._y)
+        elif self._pen:
             self._path.line(self._last_x, self._last_y, self._x, self._y)
         else:
             self._path.move(self._x, self._y)
         self._last_x, self._last_y = self._x, self._y
 
-    def _parse_code_special(self, special):
-        if special == END_OF_SHAPE:
-            self._end_of_shape()
-        elif special == PEN_DOWN:
-            self._pen_down()
-        elif special == PEN_UP:
-            self._pen_up()
-        elif special == DIVIDE_VECTOR:
-            self._divide_vector()
-        elif special == MULTIPLY_VECTOR:
-            self._multiply_vector()
-        elif special == PUSH_STACK:
-            self._push_stack()
-        elif special == POP_STACK:
-            self._pop_stack()
-        elif special == DRAW_SUBSHAPE:
-            self._draw_subshape()
-        elif special == XY_DISPLACEMENT:
-            self._xy_displacement()
-        elif special == POLY_XY_DISPLACEMENT:
-            self._poly_xy_displacement()
-        elif special == OCTANT_ARC:
-            self._octant_arc()
-        elif special == FRACTIONAL_ARC:
-            self._fractional_arc()
-        elif special == BULGE_ARC:
-            self._bulge_arc()
-        elif special == POLY_BULGE_ARC:
-            self._poly_bulge_arc()
-        elif special == COND_MODE_2:
-            self._cond_mode_2()
-
     def _end_of_shape(self):
         """
-        End of shape definition.
+        End of shape definition. Skips any null terminated data that follows the end within the current shape. Once
+        a subshape is exhausted the shape that drew it continues, only the end of the outermost shape ends the path.
         :return:
         """
-        try:
-            while self.pop() != 0:
-                pass
-        except ShxFontParseError:
-            pass
+        code = self._code
+        pc = self._pc
+        while pc < len(code):
+            pc += 1
+            if code[pc - 1] == 0:
+                break
+        self._pc = pc
         if self._debug:
             print("END_OF_SHAPE")
         if self._skip:
             self._skip = False
             return
-        self._path.new_path()
+        if not self._frames:
+            self._path.new_path()
+
+    def _undefined(self):
+        """
+        Special code 0x0F is not defined and does nothing.
+        :return:
+        """
+        if self._debug:
+            print("UNDEFINED")
 
     def _pen_down(self):
         """
@@ -494,7 +1738,8 @@ class ShxFont:
 
         :return:
         """
-        factor = self.pop()
+        factor = self._code[self._pc]
+        self._pc += 1
         if self._debug:
             print(f"DIVIDE_VECTOR {self._scale}/{factor} {'(Skipped)' if self._skip else ''}")
         if factor == 0:
@@ -510,7 +1755,8 @@ class ShxFont:
 
         :return:
         """
-        factor = self.pop()
+        factor = self._code[self._pc]
+        self._pc += 1
         if self._debug:
             print(f"MULTIPLY_VECTOR {self._scale}*{factor} {'(Skipped)' if self._skip else ''}")
         if factor == 0:
@@ -533,7 +1779,7 @@ class ShxFont:
             self._skip = False
             return
         self._stack.append((self._x, self._y))
-        if len(self._stack) == 4:
+        if len(self._stack) == STACK_DEPTH:
             raise IndexError(
                 f"Position stack overflow in shape {self._letter}"
             )
@@ -559,52 +1805,62 @@ class ShxFont:
         self._path.move(self._x, self._y)
         self._last_x, self._last_y = self._x, self._y
 
+    def _call_subshape(self, subshape):
+        """
+        Pushes the current frame onto the call stack and continues with the subshape program.
+        """
+        try:
+            shape = self.glyphs[subshape]
+        except KeyError as e:
+            raise ShxFontParseError("Referenced subshape does not exist.") from e
+        if len(self._frames) >= SUBSHAPE_DEPTH:
+            raise ShxFontParseError(f"Subshapes nested too deeply in shape {self._letter}")
+        self._frames.append((self._code, self._signed, self._pc))
+        self._code = memoryview(shape)
+        self._signed = self._code.cast("b")
+        self._pc = 0
+
     def _draw_subshape_shapes(self):
-        subshape = self.pop()
+        subshape = self._code[self._pc]
+        self._pc += 1
         if self._debug:
             print(f"Appending glyph {subshape} (Type={self.type}). {'(Skipped)' if self._skip else ''}")
         if self._skip:
             self._skip = False
             return
-        try:
-            shape = self.glyphs[subshape]
-        except KeyError as e:
-            raise ShxFontParseError("Referenced subshape does not exist.") from e
-        self._code += bytearray(reversed(shape))
+        self._call_subshape(subshape)
 
     def _draw_subshape_bigfont(self):
-        subshape = self.pop()
+        code = self._code
+        pc = self._pc
+        subshape = code[pc]
+        self._pc = pc + 1
         if self._debug:
             print(f"Appending glyph {subshape} (Type={self.type}). {'(Skipped)' if self._skip else ''}")
         if subshape == 0:
-            subshape = int_16le([self.pop(), self.pop()])
-            origin_x = self.pop() * self._scale
-            origin_y = self.pop() * self._scale
-            width = self.pop() * self._scale
-            height = self.pop() * self._scale
+            subshape = int_16be(code[pc + 1:pc + 3])
+            origin_x = code[pc + 3] * self._scale
+            origin_y = code[pc + 4] * self._scale
+            width = code[pc + 5] * self._scale
+            height = code[pc + 6] * self._scale
+            self._pc = pc + 7
             if self._debug:
                 print(f"Extended Bigfont Glyph: {subshape}, origin_x = {origin_x}, origin_y = {origin_y}. {width}x{height}")
         if self._skip:
             self._skip = False
             return
-        try:
-            shape = self.glyphs[subshape]
-        except KeyError as e:
-            raise ShxFontParseError("Referenced subshape does not exist.") from e
-        self._code += bytearray(reversed(shape))
+        self._call_subshape(subshape)
 
     def _draw_subshape_unifont(self):
-        subshape = int_16le([self.pop(), self.pop()])
+        pc = self._pc
+        subshape = int_16be(self._code[pc:pc + 2])
+        self._pc = pc + 2
         if self._debug:
             print(f"Appending glyph {subshape} (Type={self.type}). {'(Skipped)' if self._skip else ''}")
         if self._skip:
             self._skip = False
             return
-        try:
-            shape = self.glyphs[subshape]
-        except KeyError as e:
-            raise ShxFontParseError("Referenced subshape does not exist.") from e
-        self._code += bytearray(reversed(shape))
+        self._call_subshape(subshape)
 
     def _draw_subshape(self):
         """
@@ -628,8 +1884,11 @@ class ShxFont:
         ranges from -128 to +127.
         :return:
         """
-        dx = signed8(self.pop()) * self._scale
-        dy = signed8(self.pop()) * self._scale
+        signed = self._signed
+        pc = self._pc
+        dx = signed[pc] * self._scale
+        dy = signed[pc + 1] * self._scale
+        self._pc = pc + 2
         if self._debug:
             print(f"XY_DISPLACEMENT {dx} {dy} {'(Skipped)' if self._skip else ''}")
         if self._skip:
@@ -648,9 +1907,12 @@ class ShxFont:
         XY displacement in a series terminated with (0,0)
         :return:
         """
+        signed = self._signed
         while True:
-            dx = signed8(self.pop()) * self._scale
-            dy = signed8(self.pop()) * self._scale
+            pc = self._pc
+            dx = signed[pc] * self._scale
+            dy = signed[pc + 1] * self._scale
+            self._pc = pc + 2
             if self._debug:
                 print(f"POLY_XY_DISPLACEMENT {dx} {dy} {'(Skipped)' if self._skip else ''}")
             if dx == 0 and dy == 0:
@@ -685,8 +1947,10 @@ class ShxFont:
         and the span.
         :return:
         """
-        radius = self.pop() * self._scale
-        sc = signed8(self.pop())
+        pc = self._pc
+        radius = self._code[pc] * self._scale
+        sc = self._signed[pc + 1]
+        self._pc = pc + 2
         s = (sc >> 4) & 0x7
         c = sc & 0x7
         if self._debug:
@@ -711,7 +1975,7 @@ class ShxFont:
         self._x = cx + radius * cos(end_angle)
         self._y = cy + radius * sin(end_angle)
         if self._pen:
-            self._path.arc(self._last_x, self._last_y, mx, my, self._x, self._y)
+            self._arc(mx, my, cx, cy, radius, start_angle, end_angle)
         else:
             self._path.move(self._x, self._y)
         self._last_x, self._last_y = self._x, self._y
@@ -725,11 +1989,14 @@ class ShxFont:
         95° -> (95 - 90) * (256 / 45) = 28 (octent 2)
         90° + (28/256 * 45°) = 95°
         """
+        code = self._code
+        pc = self._pc
         octant = tau / 8.0
-        start_offset = octant * self.pop() / 256.0
-        end_offset = octant * self.pop() / 256.0
-        radius = (256 * self.pop() + self.pop()) * self._scale
-        sc = signed8(self.pop())
+        start_offset = octant * code[pc] / 256.0
+        end_offset = octant * code[pc + 1] / 256.0
+        radius = (256 * code[pc + 2] + code[pc + 3]) * self._scale
+        sc = self._signed[pc + 4]
+        self._pc = pc + 5
         s = (sc >> 4) & 0x7
         c = sc & 0x7
 
@@ -754,7 +2021,7 @@ class ShxFont:
         self._x = cx + radius * cos(end_angle)
         self._y = cy + radius * sin(end_angle)
         if self._pen:
-            self._path.arc(self._last_x, self._last_y, mx, my, self._x, self._y)
+            self._arc(mx, my, cx, cy, radius, start_angle, end_angle)
         else:
             self._path.move(self._x, self._y)
         self._last_x, self._last_y = self._x, self._y
@@ -769,15 +2036,51 @@ class ShxFont:
         :return:
         """
 
-        dx = signed8(self.pop()) * self._scale
-        dy = signed8(self.pop()) * self._scale
-        h = signed8(self.pop())
+        signed = self._signed
+        pc = self._pc
+        dx = signed[pc] * self._scale
+        dy = signed[pc + 1] * self._scale
+        h = signed[pc + 2]
+        self._pc = pc + 3
 
         if self._debug:
             print(f"BULGE_ARC {dx}, {dy}, {h} {'(Skipped)' if self._skip else ''}")
         if self._skip:
             self._skip = False
             return
+        self._bulge(dx, dy, h)
+
+    def _poly_bulge_arc(self):
+        """
+        Similar to bulge but repeated, until X and Y are (0,0).
+        :return:
+        """
+        signed = self._signed
+        h = 0
+        while True:
+            pc = self._pc
+            dx = signed[pc] * self._scale
+            dy = signed[pc + 1] * self._scale
+            self._pc = pc + 2
+            if self._debug:
+                print(f"POLY_BULGE_ARC {dx}, {dy}, {h} {'(Skipped)' if self._skip else ''}")
+            if dx == 0 and dy == 0:
+                if self._debug:
+                    print(f"POLY_BULGE_ARC (TERMINATED)")
+                break
+            h = signed[self._pc]
+            self._pc += 1
+            if self._skip:
+                continue
+            self._bulge(dx, dy, h)
+        if self._skip:
+            self._skip = False
+
+    def _bulge(self, dx, dy, h):
+        """
+        Draws a bulge arc to the displacement dx, dy. The bulge h is the height of the arc above the chord as a fraction
+        of half the chord, times 127.
+        """
         r = abs(complex(dx, dy)) / 2
         bulge = h / 127.0
         bx = self._x + (dx / 2)
@@ -785,54 +2088,51 @@ class ShxFont:
         bulge_angle = atan2(dy, dx) - tau / 4
         mx = bx + r * bulge * cos(bulge_angle)
         my = by + r * bulge * sin(bulge_angle)
+        x0, y0 = self._x, self._y
         self._x += dx
         self._y += dy
         if self._pen:
             if bulge == 0:
                 self._path.line(self._last_x, self._last_y, self._x, self._y)
-            else:
+            elif self._center_arc is None or r == 0:
+                # Without a chord there is no circle, the arc collapses onto the pen like the 3-point arc does.
                 self._path.arc(self._last_x, self._last_y, mx, my, self._x, self._y)
+            else:
+                # The control point is the bulge height from the chord, the center is a radius back from it.
+                height = r * abs(bulge)
+                radius = (height * height + r * r) / (2 * height)
+                if bulge > 0:
+                    bulge_angle += tau / 2
+                cx = mx + radius * cos(bulge_angle)
+                cy = my + radius * sin(bulge_angle)
+                start_angle = atan2(y0 - cy, x0 - cx)
+                # Bulges are tan(sweep / 4), the control point sits right of the chord for counterclockwise arcs.
+                sweep = 4 * atan(bulge)
+                self._arc(mx, my, cx, cy, radius, start_angle, start_angle + sweep)
         else:
             self._path.move(self._x, self._y)
         self._last_x, self._last_y = self._x, self._y
 
-    def _poly_bulge_arc(self):
+    def _arc(self, mx, my, cx, cy, radius, start_angle, end_angle):
         """
-        Similar to bulge but repeated, until X and Y are (0,0).
-        :return:
+        Draws an arc from the last position to the current position. Paths with a center_arc() method are given the
+        circle of the arc, other paths are given the control point mx, my on the arc.
         """
-        h = 0
-        while True:
-            dx = signed8(self.pop()) * self._scale
-            dy = signed8(self.pop()) * self._scale
-            if self._debug:
-                print(f"POLY_BULGE_ARC {dx}, {dy}, {h} {'(Skipped)' if self._skip else ''}")
-            if dx == 0 and dy == 0:
-                if self._debug:
-                    print(f"POLY_BULGE_ARC (TERMINATED)")
-                break
-            h = signed8(self.pop())
-            if self._skip:
-                continue
-            r = abs(complex(dx, dy)) / 2
-            bulge = h / 127.0
-            bx = self._x + (dx / 2)
-            by = self._y + (dy / 2)
-            bulge_angle = atan2(dy, dx) - tau / 4
-            mx = bx + r * bulge * cos(bulge_angle)
-            my = by + r * bulge * sin(bulge_angle)
-            self._x += dx
-            self._y += dy
-            if self._pen:
-                if bulge == 0:
-                    self._path.line(self._last_x, self._last_y, self._x, self._y)
-                else:
-                    self._path.arc(self._last_x, self._last_y, mx, my, self._x, self._y)
-            else:
-                self._path.move(self._x, self._y)
-            self._last_x, self._last_y = self._x, self._y
-        if self._skip:
-            self._skip = False
+        if self._center_arc is None:
+            self._path.arc(self._last_x, self._last_y, mx, my, self._x, self._y)
+        else:
+            self._center_arc(
+                self._last_x,
+                self._last_y,
+                self._x,
+                self._y,
+                cx,
+                cy,
+                radius,
+                start_angle,
+                end_angle,
+                end_angle > start_angle,
+            )
 
     def _cond_mode_2(self):
         """
@@ -846,3 +2146,22 @@ class ShxFont:
             if self._debug:
                 print("SKIP NEXT")
             self._skip = True
+
+    _specials = (
+        _end_of_shape,
+        _pen_down,
+        _pen_up,
+        _divide_vector,
+        _multiply_vector,
+        _push_stack,
+        _pop_stack,
+        _draw_subshape,
+        _xy_displacement,
+        _poly_xy_displacement,
+        _octant_arc,
+        _fractional_arc,
+        _bulge_arc,
+        _poly_bulge_arc,
+        _cond_mode_2,
+        _undefined,
+    )  # Special command dispatch table, indexed by special code.
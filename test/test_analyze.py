@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from shxparser.shxparser import ShxFont, ShxFontParseError, ShxPath
+
+
+def write_shapes(filename, glyphs, above=10, below=2):
+    """
+    Writes a minimal shapes font with the given glyph programs.
+    """
+    entries = [(0, b"TEST\x00" + bytes([above, below, 0, 0]))]
+    for index, code in sorted(glyphs.items()):
+        entries.append((index, b"\x00" + bytes(code)))
+    with open(filename, "wb") as f:
+        f.write(b"AutoCAD-86 shapes 1.0\r\n\x1a")
+        f.write(int.to_bytes(1, 2, "little"))
+        f.write(int.to_bytes(max(glyphs), 2, "little"))
+        f.write(int.to_bytes(len(entries), 2, "little"))
+        for index, data in entries:
+            f.write(int.to_bytes(index, 2, "little"))
+            f.write(int.to_bytes(len(data), 2, "little"))
+        for index, data in entries:
+            f.write(data)
+
+
+class TestAnalyze(unittest.TestCase):
+    """Tests the static glyph analysis."""
+
+    def test_analyze(self):
+        glyphs = {
+            ord("A"): [7, ord("B"), 0],
+            ord("B"): [7, ord("A"), 0],
+            ord("C"): [7, 99, 0],
+            ord("D"): [5, 0x14, 0],
+            ord("E"): [1, 0x14, 5, 0x10, 6, 0],
+            ord("F"): [7, ord("E"), 7, ord("E"), 0],
+            ord("G"): [7, ord("A"), 0],
+            # Rendering carries on after an end, past the data up to the next null.
+            ord("H"): [1, 0x14, 0, ord("H"), 0, 7, 99, 0],
+            ord("I"): [1, 0x14, 0, 0, 8, 1],
+            ord("J"): [3, 0, 0],
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test.shx")
+            write_shapes(filename, glyphs)
+            shx = ShxFont(filename)
+        analysis = shx.analyze()
+        self.assertIs(analysis, shx.analyze())
+        self.assertTrue(analysis[ord("A")].cycle)
+        self.assertTrue(analysis[ord("B")].cycle)
+        self.assertTrue(analysis[ord("G")].cycle)
+        self.assertEqual(analysis[ord("G")].cost, float("inf"))
+        self.assertEqual(analysis[ord("C")].missing, [99])
+        self.assertIn("stack imbalance", analysis[ord("D")].errors)
+        self.assertTrue(analysis[ord("E")].valid)
+        self.assertEqual(analysis[ord("E")].stack_max, 1)
+        self.assertTrue(analysis[ord("F")].valid)
+        self.assertEqual(analysis[ord("F")].subshapes, [ord("E"), ord("E")])
+        self.assertEqual(analysis[ord("F")].cost, 3 + 2 * analysis[ord("E")].cost)
+        self.assertEqual(analysis[ord("H")].missing, [99])
+        self.assertTrue(analysis[ord("I")].truncated)
+        self.assertIn("zero vector factor", analysis[ord("J")].errors)
+        for index in (ord("H"), ord("I"), ord("J")):
+            with self.assertRaises(ShxFontParseError):
+                shx.render(ShxPath(), chr(index))
@@ -0,0 +1,63 @@
+import json
+import os
+import struct
+import tempfile
+import unittest
+
+from shxparser.shxbatch import main
+
+PARSE = os.path.join(os.path.dirname(__file__), "parse")
+
+
+class TestBatch(unittest.TestCase):
+    """Tests the batch render command line."""
+
+    def run_jobs(self, jobs, *args):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "jobs.jsonl")
+            output = os.path.join(directory, "out")
+            with open(source, "w") as f:
+                for job in jobs:
+                    f.write(json.dumps(job) + "\n")
+            status = main([source, "-o", output, *args])
+            with open(output, "rb") as f:
+                return status, f.read()
+
+    def test_batch_formats(self):
+        font = os.path.join(PARSE, "romans.shx")
+        jobs = [
+            {"font": font, "text": "SVG", "size": 10},
+            {"font": font, "text": "G", "format": "gcode", "x": 100, "y": 50},
+        ]
+        status, data = self.run_jobs(jobs)
+        self.assertEqual(status, 0)
+        svg, gcode = data.split(b"</svg>\n")
+        self.assertTrue(svg.startswith(b"<svg"))
+        self.assertTrue(gcode.startswith(b"G90\nG0 X1"))
+
+    def test_batch_pool(self):
+        font = os.path.join(PARSE, "romans.shx")
+        jobs = [{"font": font, "text": str(i)} for i in range(20)]
+        jobs.insert(5, {"font": os.path.join(PARSE, "missing.shx"), "text": "x"})
+        status, pooled = self.run_jobs(jobs, "-f", "binary", "-j", "2", "--chunksize", "3", "-p", font)
+        self.assertEqual(status, 1)
+        _, serial = self.run_jobs(jobs, "-f", "binary")
+        self.assertEqual(pooled, serial)
+        count = 0
+        while pooled:
+            (length,) = struct.unpack_from("<I", pooled)
+            pooled = pooled[4 + length:]
+            count += 1
+        self.assertEqual(count, 20)
+
+    def test_batch_overflow(self):
+        font = os.path.join(PARSE, "romans.shx")
+        jobs = [
+            {"font": font, "text": "A", "format": "binary", "x": 1e300},
+            {"font": font, "text": "B", "format": "binary"},
+        ]
+        status, data = self.run_jobs(jobs)
+        self.assertEqual(status, 1)
+        (length,) = struct.unpack_from("<I", data)
+        self.assertEqual(len(data), 4 + length)
+        self.assertGreater(length, 0)
@@ -0,0 +1,54 @@
+import gc
+import os
+import unittest
+
+from shxparser.shxparser import ShxFont, ShxGlyphPool, ShxRenderCache
+
+PARSE = os.path.join(os.path.dirname(__file__), "parse")
+
+
+class TestPool(unittest.TestCase):
+    """Tests interning glyph data across fonts."""
+
+    def test_pool_fonts(self):
+        pool = ShxGlyphPool()
+        filename = os.path.join(PARSE, "romans.shx")
+        first = ShxFont(filename, pool=pool)
+        second = ShxFont(filename, pool=pool)
+        for index, data in first.glyphs.items():
+            self.assertIs(data, second.glyphs[index])
+        self.assertGreater(pool.saved, 0)
+        size = pool.size
+        subset = second.subset("A")
+        self.assertIs(subset.glyphs[ord("A")], first.glyphs[ord("A")])
+        self.assertEqual(pool.size, size)
+
+        del first, second, subset
+        gc.collect()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.references, 0)
+        self.assertEqual(pool.saved, 0)
+
+    def test_pool_disabled(self):
+        filename = os.path.join(PARSE, "romans.shx")
+        first = ShxFont(filename, pool=None)
+        second = ShxFont(filename, pool=None)
+        self.assertIsNot(first.glyphs[ord("A")], second.glyphs[ord("A")])
+        self.assertEqual(first.glyphs[ord("A")], second.glyphs[ord("A")])
+
+    def test_pool_render_cache(self):
+        pool = ShxGlyphPool()
+        filename = os.path.join(PARSE, "romans.shx")
+        first = ShxFont(filename, pool=pool)
+        second = ShxFont(filename, pool=pool)
+        cache = ShxRenderCache(pool=pool)
+        a = cache.result(first, "Hello")
+        b = cache.result(second, "Hello")
+        self.assertIsNot(a, b)
+        self.assertIs(a.coords, b.coords)
+        references = pool.references
+        cache.clear()
+        self.assertEqual(pool.references, references - 4)
+        del cache, first, second
+        gc.collect()
+        self.assertEqual(len(pool), 0)
@@ -0,0 +1,295 @@
+import gc
+import os
+import tempfile
+import unittest
+from math import cos, sin, tau
+from random import Random
+
+from shxparser.shxparser import (
+    SEGMENT_LENGTHS,
+    ShxFont,
+    ShxFontParseError,
+    ShxHitIndex,
+    ShxPath,
+    ShxRenderCache,
+    text_matrix,
+)
+
+from .test_analyze import write_shapes
+
+PARSE = os.path.join(os.path.dirname(__file__), "parse")
+
+
+def load_shapes(glyphs):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "test.shx")
+        write_shapes(filename, glyphs)
+        return ShxFont(filename)
+
+
+class TestRender(unittest.TestCase):
+    """Tests the glyph program interpreter."""
+
+    def test_render_subshape(self):
+        glyphs = {
+            ord("A"): [1, 0x14, 8, 2, 3, 0],
+            ord("B"): [2, 0x20, 7, ord("A"), 0x1C, 0],
+            ord("C"): [2, 0x20, 1, 0x14, 8, 2, 3, 0x1C, 0],
+        }
+        inline = ShxPath()
+        load_shapes(glyphs).render(inline, "C")
+        called = ShxPath()
+        load_shapes(glyphs).render(called, "B")
+        self.assertEqual(inline.path, called.path)
+        self.assertEqual(len(called.path), 6)
+        self.assertIsNone(called.path[-1])
+
+    def test_render_subshape_cycle(self):
+        shx = load_shapes(
+            {
+                ord("A"): [1, 0x14, 7, ord("B"), 0],
+                ord("B"): [7, ord("A"), 0],
+            }
+        )
+        with self.assertRaises(ShxFontParseError):
+            shx.render(ShxPath(), "A")
+
+    def test_render_matrix(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0x20, 0x0A, 2, 0x00, 0]})
+        plain = ShxPath()
+        shx.render(plain, "A", x=0, y=0)
+        rotated = ShxPath()
+        shx.render(rotated, "A", x=5, y=7, matrix=text_matrix(rotation=tau / 4))
+        self.assertEqual(len(plain.path), len(rotated.path))
+        for p, r in zip(plain.path, rotated.path):
+            if p is None:
+                self.assertIsNone(r)
+                continue
+            for i in range(0, len(p), 2):
+                self.assertAlmostEqual(r[i], 5 - p[i + 1])
+                self.assertAlmostEqual(r[i + 1], 7 + p[i])
+
+    def test_render_matrix_continue(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0x20, 0x0A, 2, 0x00, 0], ord("B"): [1, 0x34, 0]})
+        matrix = text_matrix(rotation=tau / 8)
+        once = ShxPath()
+        shx.render(once, "ABBA", x=100, y=50, matrix=matrix)
+        twice = ShxPath()
+        shx.render(twice, "AB", x=100, y=50, matrix=matrix)
+        shx.render(twice, "BA", matrix=matrix)
+        self.assertEqual(len(once.path), len(twice.path))
+        for p, q in zip(once.path, twice.path):
+            if p is None:
+                self.assertIsNone(q)
+                continue
+            for a, b in zip(p, q):
+                self.assertAlmostEqual(a, b)
+
+    def test_render_width_factor(self):
+        shx = load_shapes({ord("A"): [1, 0x0A, 2, 0x00, 0]})
+        path = ShxPath()
+        shx.render(path, "A", x=0, y=0, font_size=10, matrix=text_matrix(width_factor=2.0))
+        arcs = [p for p in path.path if p is not None and len(p) == 6]
+        self.assertGreater(len(arcs), 8)
+        # Circle of radius 2 centered 2 to the left of the origin, width factor 2.
+        for p in arcs:
+            for i in range(0, 6, 2):
+                x = p[i] / 2.0
+                y = p[i + 1]
+                self.assertAlmostEqual((x + 2) ** 2 + y ** 2, 4)
+
+    def test_render_cache(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0x20, 0x0A, 2, 0x00, 0], ord("B"): [1, 0x34, 0]})
+        direct = ShxPath()
+        shx.render(direct, "AB", x=3, y=4)
+        direct_end = shx._x, shx._y
+        cache = ShxRenderCache()
+        for i in range(3):
+            cached = ShxPath()
+            end = cache.render(shx, cached, "AB", x=3, y=4)
+            self.assertAlmostEqual(end[0], direct_end[0])
+            self.assertAlmostEqual(end[1], direct_end[1])
+            self.assertEqual(len(direct.path), len(cached.path))
+            for p, c in zip(direct.path, cached.path):
+                if p is None:
+                    self.assertIsNone(c)
+                    continue
+                for a, b in zip(p, c):
+                    self.assertAlmostEqual(a, b)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_render_cache_eviction(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0]})
+        size = ShxRenderCache().result(shx, "A").size
+        cache = ShxRenderCache(max_size=2 * size)
+        for font_size in (12.0, 6.0, 12.0, 3.0):
+            cache.result(shx, "A", font_size=font_size)
+        self.assertEqual((len(cache), cache.size), (2, 2 * size))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 3, 1))
+        cache.result(shx, "A", font_size=12.0)
+        cache.result(shx, "A", font_size=6.0)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 4, 2))
+
+    def test_render_cache_pen(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0]})
+        cache = ShxRenderCache()
+        shx.render(ShxPath(), "A", x=10, y=20)
+        pen = shx._x, shx._y
+        cache.render(shx, ShxPath(), "AAA", x=100, y=100)
+        self.assertEqual((shx._x, shx._y), pen)
+        follow = ShxPath()
+        shx.render(follow, "A")
+        self.assertEqual(follow.path[0][:2], list(pen))
+
+    def test_render_cache_font_collected(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0]})
+        cache = ShxRenderCache()
+        cache.result(shx, "A")
+        cache.result(shx, "AA")
+        self.assertEqual(len(cache), 2)
+        del shx
+        gc.collect()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_render_center_arc(self):
+        class CenterPath(ShxPath):
+            def center_arc(self, x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle, ccw):
+                self.path.append([x0, y0, x1, y1, cx, cy, radius, start_angle, end_angle, ccw])
+
+        # Octant arc, fractional arc, bulge arc.
+        shx = load_shapes({ord("A"): [1, 0x0A, 2, 0x12, 0x0B, 0, 0, 0, 3, 0x02, 0x0C, 8, 0, 127, 0]})
+        for matrix in (None, text_matrix(rotation=1.0), (-1.0, 0.0, 0.0, 1.0, 0.0, 0.0)):
+            points = ShxPath()
+            shx.render(points, "A", x=1, y=2, matrix=matrix)
+            centers = CenterPath()
+            shx.render(centers, "A", x=1, y=2, matrix=matrix)
+            cached = CenterPath()
+            ShxRenderCache().render(shx, cached, "A", x=1, y=2, matrix=matrix)
+            self.assertEqual(len(centers.path), len(cached.path))
+            arcs = [(p, c) for p, c in zip(points.path, centers.path) if c is not None and len(c) == 10]
+            self.assertEqual(len(arcs), 3)
+            for p, c in arcs:
+                x0, y0, mx, my, x1, y1 = p
+                cx, cy, radius, start_angle, end_angle = c[4:9]
+                self.assertEqual(c[9], end_angle > start_angle)
+                self.assertAlmostEqual(cx + radius * cos(start_angle), x0)
+                self.assertAlmostEqual(cy + radius * sin(start_angle), y0)
+                self.assertAlmostEqual(cx + radius * cos(end_angle), x1)
+                self.assertAlmostEqual(cy + radius * sin(end_angle), y1)
+                # The 3-point control point is on the same arc.
+                self.assertAlmostEqual(cx + radius * cos((start_angle + end_angle) / 2), mx)
+                self.assertAlmostEqual(cy + radius * sin((start_angle + end_angle) / 2), my)
+
+        # A bulge arc without displacement draws no circle in any path.
+        shx = load_shapes({ord("B"): [1, 0x0C, 0, 0, 50, 0]})
+        for matrix in (None, text_matrix(rotation=1.0), text_matrix(width_factor=0.5)):
+            points = ShxPath()
+            shx.render(points, "B", x=1, y=2, matrix=matrix)
+            centers = CenterPath()
+            shx.render(centers, "B", x=1, y=2, matrix=matrix)
+            cached = CenterPath()
+            ShxRenderCache().render(shx, cached, "B", x=1, y=2, matrix=matrix)
+            self.assertEqual(points.path, centers.path)
+            self.assertEqual(points.path, cached.path)
+
+    def test_render_codec(self):
+        filename = os.path.join(PARSE, "gbcbig.shx")
+        shx = ShxFont(filename, codec="gbk")
+        translation = shx.translation()
+        self.assertIs(translation, shx.translation())
+        self.assertEqual(translation[ord("中")], 0xD6D0)
+        self.assertNotIn(ord("中"), ShxFont(filename).translation())
+        encoded = ShxPath()
+        ShxFont(filename).render(encoded, chr(0xD6D0) + chr(0xCEC4))
+        decoded = ShxPath()
+        shx.render(decoded, "中文")
+        self.assertTrue(decoded.path)
+        self.assertEqual(encoded.path, decoded.path)
+        self.assertIn(0xD6D0, shx.subset("中").glyphs)
+
+    def test_render_segments(self):
+        class SegmentPath:
+            def __init__(self):
+                self.glyphs = list()
+
+            def segments(self, codes, coords):
+                self.glyphs.append((codes, coords))
+
+        shx = load_shapes({ord("A"): [1, 0x14, 0x20, 0x0A, 2, 0x00, 0], ord("B"): [2, 0x34, 1, 0x0C, 4, 0, 127, 0]})
+        for matrix in (None, text_matrix(width_factor=0.5)):
+            calls = ShxPath()
+            shx.render(calls, "AB", x=1, y=2, matrix=matrix)
+            bulk = SegmentPath()
+            shx.render(bulk, "AB", x=1, y=2, matrix=matrix)
+            self.assertEqual(len(bulk.glyphs), 2)
+            cached = SegmentPath()
+            ShxRenderCache().render(shx, cached, "AB", x=1, y=2, matrix=matrix)
+            self.assertEqual(len(cached.glyphs), 1)
+            for glyphs in (bulk.glyphs, cached.glyphs):
+                segments = list()
+                for codes, coords in glyphs:
+                    self.assertNotIn(4, codes)
+                    i = 0
+                    for code in codes:
+                        n = SEGMENT_LENGTHS[code]
+                        segments.append(coords[i : i + n] if code else None)
+                        i += n
+                    self.assertEqual(i, len(coords))
+                self.assertEqual(len(calls.path), len(segments))
+                for p, c in zip(calls.path, segments):
+                    if p is None:
+                        self.assertIsNone(c)
+                        continue
+                    for a, b in zip(p, c):
+                        self.assertAlmostEqual(a, b)
+
+    def test_render_hits(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0x20, 0x0A, 2, 0x00, 0], ord("B"): [1, 0x34, 0], ord(" "): [2, 0x40, 0]})
+        plain = ShxPath()
+        shx.render(plain, "AB BA", x=0, y=0, font_size=10)
+        hits = ShxHitIndex()
+        path = ShxPath()
+        shx.render(path, "AB BA?", x=0, y=0, font_size=10, hits=hits)
+        self.assertEqual(plain.path, path.path)
+        self.assertEqual(len(hits), 6)
+        self.assertEqual(hits.count, len(path.path))
+        self.assertIsNone(hits.bounds[2])
+        self.assertEqual(hits.segment_range(5), range(len(path.path), len(path.path)))
+        for i in range(5):
+            min_x, min_y, max_x, max_y = hits.bounds[i] or (0, 0, 0, 0)
+            segments = hits.segment_range(i)
+            self.assertEqual(hits.segment_range(0, i + 1).stop, segments.stop)
+            for p in path.path[segments.start : segments.stop]:
+                if p is None or len(p) == 2:
+                    continue
+                for j in range(0, len(p), 2):
+                    self.assertTrue(min_x - 1e-9 <= p[j] <= max_x + 1e-9)
+                    self.assertTrue(min_y - 1e-9 <= p[j + 1] <= max_y + 1e-9)
+        # The circle of A has radius 2 and is centered 2 to the left of its start.
+        self.assertAlmostEqual(hits.bounds[0][0], -2)
+        self.assertEqual(hits.point(-1.5, 1), [0])
+        self.assertEqual(hits.point(*hits.bounds[3][2:]), [3, 4])
+        self.assertEqual(hits.rect(-100, -100, 100, 100), [0, 1, 3, 4])
+        self.assertEqual(hits.point(-100, -100), [])
+
+    def test_render_hits_scattered(self):
+        shx = load_shapes({ord("A"): [1, 0x14, 0x20, 0x0A, 2, 0x00, 0], ord("B"): [1, 0x34, 0], ord(" "): [2, 0x40, 0]})
+        random = Random(7)
+        hits = ShxHitIndex()
+        for label in range(300):
+            shx.render(ShxPath(), "AB BA", x=random.uniform(0, 1000), y=random.uniform(0, 1000), hits=hits)
+            if label % 37:
+                continue
+            # Queries between renders see the characters added so far.
+            for _ in range(20):
+                x, y = random.uniform(0, 1000), random.uniform(0, 1000)
+                rect = x, y, x + random.uniform(0, 50), y + random.uniform(0, 50)
+                expected = [
+                    i
+                    for i, b in enumerate(hits.bounds)
+                    if b is not None and b[0] <= rect[2] and b[2] >= rect[0] and b[1] <= rect[3] and b[3] >= rect[1]
+                ]
+                self.assertEqual(hits.rect(*rect), expected)
+        for i, b in enumerate(hits.bounds):
+            if b is not None:
+                self.assertIn(i, hits.point((b[0] + b[2]) / 2, (b[1] + b[3]) / 2))
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+
+from shxparser.shxparser import ShxFont, ShxFontParseError, ShxPath, read_int_16le, read_int_32le
+
+from .test_analyze import write_shapes
+
+PARSE = os.path.join(os.path.dirname(__file__), "parse")
+
+
+def read_bigfont_info(filename):
+    with open(filename, "rb") as f:
+        f.readline()
+        f.read(1)
+        read_int_16le(f)
+        count = read_int_16le(f)
+        f.seek(4 * read_int_16le(f), 1)
+        for i in range(count):
+            index, length, offset = read_int_16le(f), read_int_16le(f), read_int_32le(f)
+            if index == 0:
+                f.seek(offset)
+                return f.read(length)
+
+
+class TestWriter(unittest.TestCase):
+    """Tests writing and subsetting fonts."""
+
+    def assertFontEqual(self, a, b):
+        for attr in (
+            "format",
+            "type",
+            "version",
+            "font_name",
+            "above",
+            "below",
+            "modes",
+            "info_end",
+            "encoding",
+            "embedded",
+            "changes",
+            "glyphs",
+            "names",
+        ):
+            self.assertEqual(getattr(a, attr), getattr(b, attr), attr)
+
+    def test_write_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "out.shx")
+            for name in ("romans.shx", "ROMANS8.SHX", "bigfont.shx", "gbcbig.shx", "txt.shx"):
+                shx = ShxFont(os.path.join(PARSE, name))
+                shx.write(filename)
+                self.assertFontEqual(shx, ShxFont(filename))
+            # Extended bigfonts keep the character width after the modes.
+            original = os.path.join(PARSE, "extfont.shx")
+            ShxFont(original).subset("A").write(filename)
+            self.assertEqual(read_bigfont_info(filename), read_bigfont_info(original))
+            self.assertEqual(read_bigfont_info(filename)[-5:], b"\x0f\x00\x02\x0e\x00")
+            # Shape libraries start the header with their lowest shape number.
+            for name in ("AC.SHX", "ES.SHX"):
+                original = os.path.join(PARSE, name)
+                ShxFont(original).write(filename)
+                with open(original, "rb") as a, open(filename, "rb") as b:
+                    self.assertEqual(a.read(), b.read(), name)
+
+    def test_subset(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test.shx")
+            write_shapes(
+                filename,
+                {
+                    ord("A"): [1, 0x14, 0],
+                    ord("B"): [7, ord("A"), 0x10, 0],
+                    ord("C"): [7, ord("D"), 0],
+                    ord("D"): [1, 0x1C, 0],
+                },
+            )
+            shx = ShxFont(filename)
+            subset = shx.subset("B")
+            self.assertEqual(sorted(subset.glyphs), [ord("A"), ord("B")])
+            subset.write(filename)
+            subset = ShxFont(filename)
+        self.assertEqual(sorted(subset.glyphs), [ord("A"), ord("B")])
+        original = ShxPath()
+        shx.render(original, "B")
+        rendered = ShxPath()
+        subset.render(rendered, "B")
+        self.assertEqual(original.path, rendered.path)
+
+    def test_write_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test.shx")
+            subset = ShxFont(os.path.join(PARSE, "AC.SHX")).subset("Hello 12")
+            self.assertEqual(subset.glyphs, {})
+            subset.write(filename)
+            self.assertEqual(ShxFont(filename).glyphs, {})
+            with open(filename, "wb") as f:
+                f.write(b"keep")
+            with self.assertRaises(ShxFontParseError):
+                ShxFont(None).write(filename)
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"keep")